@@ -13,6 +13,7 @@ setup(
     scripts = ['script/tsapp'],
     packages = find_packages(exclude=['test']),
     install_requires = ['cherrypy'],
+    extras_require = {'gevent': ['gevent']},
     include_package_data = True,
     zip_safe = False
     )
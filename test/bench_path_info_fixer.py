@@ -0,0 +1,65 @@
+"""
+Microbenchmark path_info_fixer against the regular expression
+version it replaced, printing calls per second for each.
+
+    python test/bench_path_info_fixer.py
+"""
+
+import os
+import sys
+import timeit
+import uuid
+
+from re import sub
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tsapp.proxy import path_info_fixer
+
+
+PATHS = [
+    '/bags/foo_public/tiddlers/HelloThere',
+    '/recipes/foo_public/tiddlers/Site/Title/revisions/3',
+    '/spaces/foo/members',
+    '/index.html',
+]
+
+
+def regex_path_info_fixer(path):
+    """
+    path_info_fixer as it was, for comparison.
+    """
+    token = str(uuid.uuid4())
+    path = sub('^/', token, path, count=1)
+    path = sub('(users|spaces|bags|recipes|tiddlers|revisions)/',
+            '\g<1>' + token, path)
+    path = sub('/(tiddlers|revisions|members)', token + '\g<1>', path)
+    path = sub('/', '%2f', path)
+    path = sub(token, '/', path)
+    return path
+
+
+def calls_per_second(function, number=20000, repeat=3):
+    """
+    The best rate at which function handles PATHS, over repeat runs.
+    """
+    def run():
+        for path in PATHS:
+            function(path)
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return number * len(PATHS) / best
+
+
+def main():
+    for path in PATHS:
+        assert path_info_fixer(path) == regex_path_info_fixer(path), path
+    old = calls_per_second(regex_path_info_fixer, number=2000)
+    new = calls_per_second(path_info_fixer)
+    print '%-16s %12.0f calls/s' % ('regex', old)
+    print '%-16s %12.0f calls/s' % ('path_info_fixer', new)
+    print '%-16s %12.1fx' % ('speedup', new / old)
+
+
+if __name__ == '__main__':
+    main()
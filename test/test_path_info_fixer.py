@@ -0,0 +1,55 @@
+"""
+path_info_fixer must give exactly what the regular expression version
+it replaced did. Each case is (quoted PATH_INFO, expected path).
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tsapp.proxy import path_info_fixer
+
+
+CASES = [
+    # nothing to fix
+    ('/', '/'),
+    ('/index.html', '/index.html'),
+    ('/status', '/status'),
+    ('/search', '/search'),
+    ('/bags/foo_public/tiddlers', '/bags/foo_public/tiddlers'),
+    ('/bags/foo_public/tiddlers/HelloThere',
+        '/bags/foo_public/tiddlers/HelloThere'),
+    ('/recipes/foo_public/tiddlers.json', '/recipes/foo_public/tiddlers.json'),
+    ('/users/cdent', '/users/cdent'),
+    ('/spaces/foo', '/spaces/foo'),
+    ('/spaces/foo/members', '/spaces/foo/members'),
+    ('/bags/foo/tiddlers/x/revisions/3', '/bags/foo/tiddlers/x/revisions/3'),
+    ('/bags/foo/tiddlers/a%2fb', '/bags/foo/tiddlers/a%2fb'),
+    ('/bags//tiddlers', '/bags//tiddlers'),
+    # titles which had a %2f, unquoted to / by the server
+    ('/bags/foo_public/tiddlers/a/b/c', '/bags/foo_public/tiddlers/a%2fb%2fc'),
+    ('/recipes/foo_public/tiddlers/Site/Title',
+        '/recipes/foo_public/tiddlers/Site%2fTitle'),
+    ('/bags/foo/tiddlers/some%20title/with/slash',
+        '/bags/foo/tiddlers/some%20title%2fwith%2fslash'),
+    ('/bags/foo_public/tiddlers/a/b/revisions',
+        '/bags/foo_public/tiddlers/a%2fb/revisions'),
+    ('/users/cdent/identities', '/users/cdent%2fidentities'),
+    ('/spaces/foo/members/cdent', '/spaces/foo/members%2fcdent'),
+    # near misses of the collection names
+    ('/mybags/foo/bar', '/mybags/foo%2fbar'),
+    ('/bags/mytiddlers/x', '/bags/mytiddlers/x'),
+    ('/bags/a/tiddlersx/y', '/bags/a/tiddlersx%2fy'),
+    ('/foo/bar', '/foo%2fbar'),
+    ('relative/path', 'relative%2fpath'),
+    ('//double', '/%2fdouble'),
+]
+
+
+def test_path_info_fixer():
+    failures = [(path, expected, path_info_fixer(path))
+            for path, expected in CASES
+            if path_info_fixer(path) != expected]
+    assert not failures, failures
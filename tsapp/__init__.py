@@ -8,10 +8,15 @@ import getpass
 import glob
 import os
 import sys
+import tempfile
 
 
 __version__ = '0.7.0'
 
+# Parsed config files, keyed by filename, with the stat
+# signature the file had when parsed.
+_CONFIG_CACHE = {}
+
 
 def error_exit(code, message=""):
     """
@@ -22,6 +27,23 @@ def error_exit(code, message=""):
     sys.exit(code)
 
 
+def split_options(args):
+    """
+    Separate "--name=value" and "--flag" options from the
+    positional args. Return the remaining args and a dict
+    of options. A flag given without a value is set to True.
+    """
+    positional = []
+    options = {}
+    for arg in args:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value or True
+        else:
+            positional.append(arg)
+    return positional, options
+
+
 def write_config(new_data):
     """
     Update the local .tsapp file with the provided new_data
@@ -42,17 +64,26 @@ def write_config(new_data):
 def _write_config(data):
     """
     Do the actual writing of one single config file.
+
+    The data is written to a temporary file which is then renamed
+    over .tsapp, so readers never see a partly written file.
     """
-    def_umask = os.umask(0077)
-    config_file = open('./.tsapp', 'w')
+    handle, temp_path = tempfile.mkstemp(prefix='.tsapp', dir='.')
+    config_file = os.fdopen(handle, 'w')
+    config = {}
 
-    for key, value in data.iteritems():
-        key = key.strip()
-        value = value.strip()
-        config_file.write('%s:%s\n' % (key, value))
+    try:
+        for key, value in data.iteritems():
+            key = key.strip()
+            value = value.strip()
+            config_file.write('%s:%s\n' % (key, value))
+            config[key] = value
+    finally:
+        config_file.close()
 
-    config_file.close()
-    os.umask(def_umask)
+    filename = os.path.join('.', '.tsapp')
+    os.rename(temp_path, filename)
+    _CONFIG_CACHE[filename] = (_config_signature(filename), config)
 
 
 def read_config():
@@ -86,16 +117,43 @@ def _read_config(path):
     """
     Do the actual reading of one single config file.
     Return a dict of the contained info.
+
+    The file is only parsed again if its mtime, size or inode
+    have changed since it was last read.
     """
+    filename = os.path.join(path, '.tsapp')
+    signature = _config_signature(filename)
+    try:
+        cached_signature, cached_config = _CONFIG_CACHE[filename]
+        if cached_signature == signature:
+            return dict(cached_config)
+    except KeyError:
+        pass
+
     config = {}
-    config_file = open(os.path.join(path, '.tsapp'))
+    config_file = open(filename)
     for line in config_file.readlines():
         key, value = line.split(':', 1)
         key = key.strip()
         value = value.strip()
         if key and value and not key.startswith('#'):
             config[key] = value
-    return config
+    config_file.close()
+
+    _CONFIG_CACHE[filename] = (signature, config)
+    return dict(config)
+
+
+def _config_signature(filename):
+    """
+    The stat data used to tell if filename has changed.
+    Raise IOError if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError, exc:
+        raise IOError(exc.errno, exc.strerror, filename)
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
 
 
 def delete_config_property(key):
@@ -152,8 +210,10 @@ def do_auth(args):
     by putting them through the appropriate challenger.
     """
     from .auth import authenticate
+    from .http import configure
 
     config = read_config()
+    configure(config)
     user = args[0]
     password = getpass.getpass(prompt='Password: ')
 
@@ -193,6 +253,13 @@ def new_app(args):
 def push(args):
     """
     Push the assets or single tiddler to the target server, into target_bag.
+
+    Files unchanged since they were last pushed are skipped,
+    --force pushes them anyway.
+    --workers=N pushes N files at once (default: push_workers in config).
+    --gzip sends text files gzip encoded (default: push_gzip in config).
+    --watch keeps running, pushing files as they are saved and deleting
+    the tiddlers of files removed.
     """
     _push(args, hard=False)
 
@@ -200,7 +267,10 @@ def push(args):
 def push_hard(args):
     """
     Push the assets or single tiddler to the target server, into target_bag,
-    deleting the assets first.
+    deleting the assets first. All files are pushed, changed or not.
+
+    --workers=N pushes N files at once (default: push_workers in config).
+    --gzip sends text files gzip encoded (default: push_gzip in config).
     """
     _push(args, hard=True)
 
@@ -210,13 +280,16 @@ def _push(args, hard=False):
     Do the actual pushing.
     """
     from .push import push_assets
+    from .http import configure
 
+    args, options = split_options(args)
     config = read_config()
+    configure(config)
     auth_token = config.get('auth_token')
 
     target_server = config.get('target_server')
-    tiddlyweb_mode = config.get('tiddlyweb_mode')
     server_prefix = config.get('server_prefix')
+    workers = int(options.get('workers', config.get('push_workers', 1)))
     target_bag = args[0]
 
     try:
@@ -224,17 +297,71 @@ def _push(args, hard=False):
     except IndexError:
         tiddler = None
 
-    if not '_' in target_bag and not(tiddlyweb_mode):
-        target_bag = '%s_public' % target_bag
+    target_bag = _bag_name(target_bag, config)
+    gzip = bool(options.get('gzip', config.get('push_gzip')))
+
+    if options.get('watch') and not hard and not tiddler:
+        from .watch import watch_assets
+        try:
+            watch_assets(target_server, target_bag, auth_token,
+                    server_prefix=server_prefix, workers=workers, gzip=gzip,
+                    interval=float(config.get('watch_interval', 1)),
+                    debounce=float(config.get('watch_debounce', 0.5)))
+        except KeyboardInterrupt:
+            sys.exit(0)
+        return
+
+    try:
+        failed = push_assets(target_server, target_bag, auth_token,
+                tiddler=tiddler, hard=hard, server_prefix=server_prefix,
+                workers=workers, force=bool(options.get('force')),
+                gzip=gzip)
+    except Exception, exc:
+        sys.stderr.write('%s\n' % exc)
+        sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+def pull(args):
+    """
+    Pull the tiddlers in a bag on the target server into assets.
+
+    Tiddlers unchanged since they were last pulled are not downloaded
+    again, --force downloads them anyway.
+    --workers=N downloads N tiddlers at once (default: pull_workers
+    in config, or 4).
+    """
+    from .pull import pull_bag
+    from .http import configure
+
+    args, options = split_options(args)
+    config = read_config()
+    configure(config)
+
+    workers = int(options.get('workers', config.get('pull_workers', 4)))
+    target_bag = _bag_name(args[0], config)
 
     try:
-        push_assets(target_server, target_bag, auth_token,
-                tiddler=tiddler, hard=hard, server_prefix=server_prefix)
+        pull_bag(config.get('target_server'), target_bag,
+                config.get('auth_token'),
+                server_prefix=config.get('server_prefix'),
+                workers=workers, force=bool(options.get('force')))
     except Exception, exc:
         sys.stderr.write('%s\n' % exc)
         sys.exit(1)
 
 
+def _bag_name(bag, config):
+    """
+    The full name of bag on the target server. A bare space name
+    means its public bag, unless in tiddlyweb_mode.
+    """
+    if not '_' in bag and not config.get('tiddlyweb_mode'):
+        return '%s_public' % bag
+    return bag
+
+
 def delete(args):
     """
     Delete a single tiddler from the server at the named bag.
@@ -242,10 +369,12 @@ def delete(args):
     tsapp delete bag_name tiddler_title
     """
     from .delete import delete_tiddler
+    from .http import configure
 
     bag_name = args[0]
     tiddler_title = args[1]
     config = read_config()
+    configure(config)
 
     try:
         delete_tiddler(config, bag_name, tiddler_title)
@@ -254,6 +383,110 @@ def delete(args):
         sys.exit(1)
 
 
+def bench(args):
+    """
+    Benchmark serve, proxying to a local stand in for the target server.
+
+    --concurrency=N clients (10), --requests=N per scenario (1000) or
+    --duration=SECONDS per scenario, --latency=MS of the stand in (0),
+    --payload=BYTES of each tiddler (1024), --scenarios=NAME,NAME (all
+    of root, assets, bag_local, upstream_miss, put, delete), --json to
+    print machine readable results.
+    """
+    from .bench import run_bench, print_report, bench_metadata
+
+    args, options = split_options(args)
+    settings = {
+        'concurrency': int(options.get('concurrency', 10)),
+        'count': int(options.get('requests', 1000)),
+        'duration': float(options.get('duration', 0)) or None,
+        'latency': float(options.get('latency', 0)) / 1000,
+        'payload_size': int(options.get('payload', 1024)),
+        'scenarios': options.get('scenarios') and
+            options['scenarios'].split(','),
+    }
+    if settings['duration']:
+        settings['count'] = None
+
+    try:
+        summaries = run_bench(**settings)
+    except Exception, exc:
+        sys.stderr.write('%s\n' % exc)
+        sys.exit(1)
+
+    if options.get('json'):
+        import json
+        print json.dumps({'meta': bench_metadata(settings),
+            'results': summaries}, indent=1, sort_keys=True)
+    else:
+        print_report(summaries)
+
+
+def replay(args):
+    """
+    Replay the GETs in an access log against serve, at the pace they
+    were made.
+
+    --speed=N replays N times faster (1, 0 for as fast as possible),
+    --concurrency=N clients (10), --duration=SECONDS to stop after,
+    --accept=TYPE to send as Accept (*/*), --json to print machine
+    readable results. Requests go to the serve configured by port
+    and local_host, or with --fake to one started against a local
+    stand in for the target server, with --latency=MS and
+    --payload=BYTES as for bench.
+    """
+    from .replay import (parse_log, run_replay, run_fake_replay,
+            print_breakdown)
+    from .bench import print_report, bench_metadata
+
+    args, options = split_options(args)
+    try:
+        log_file = open(args[0])
+    except IOError, exc:
+        error_exit(1, 'unable to read %s: %s' % (args[0], exc.strerror))
+    try:
+        requests, skipped = parse_log(log_file)
+    finally:
+        log_file.close()
+    if not requests:
+        error_exit(1, 'no GET requests found in %s' % args[0])
+
+    settings = {
+        'speed': float(options.get('speed', 1)),
+        'concurrency': int(options.get('concurrency', 10)),
+        'duration': float(options.get('duration', 0)) or None,
+        'accept': options.get('accept', '*/*'),
+    }
+    try:
+        if options.get('fake'):
+            summary = run_fake_replay(requests,
+                    latency=float(options.get('latency', 0)) / 1000,
+                    payload_size=int(options.get('payload', 1024)),
+                    **settings)
+        else:
+            config = read_config()
+            host = config['local_host']
+            if host in ('0.0.0.0', ''):
+                host = '127.0.0.1'
+            summary = run_replay(requests, host=host,
+                    port=int(config['port']), **settings)
+    except Exception, exc:
+        sys.stderr.write('%s\n' % exc)
+        sys.exit(1)
+    summary['skipped_lines'] = skipped
+
+    if options.get('json'):
+        import json
+        settings.update(log=args[0], fake=bool(options.get('fake')))
+        print json.dumps({'meta': bench_metadata(settings),
+            'results': [summary]}, indent=1, sort_keys=True)
+    else:
+        print_report([summary])
+        print_breakdown(summary)
+        if skipped:
+            print '  %s log lines skipped, not GET or HEAD requests' % skipped
+
+
 def show_help(args):
     """
     Display this help.
@@ -267,9 +500,12 @@ COMMANDS = {
     'init': new_app,
     'push': push,
     'push_hard': push_hard,
+    'pull': pull,
     'serve': run_server,
     'auth': do_auth,
     'delete': delete,
+    'bench': bench,
+    'replay': replay,
 }
 
 
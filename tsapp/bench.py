@@ -0,0 +1,366 @@
+"""
+Benchmark `tsapp serve` end to end.
+
+A stand in TiddlyWeb server is started locally, with configurable
+latency and payload size, along with a fixture app dir. `tsapp serve`
+is run in that dir as a subprocess, proxying to the stand in, and
+concurrent clients drive it through a set of scenarios, each one
+exercising a different route through the proxy.
+"""
+
+from __future__ import absolute_import
+
+import BaseHTTPServer
+import hashlib
+import httplib
+import itertools
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+
+import tsapp
+
+
+BENCH_BAG = 'bench_public'
+
+SCENARIOS = [
+    ('root', 'GET', '/index.html'),
+    ('assets', 'GET', '/app.js'),
+    ('bag_local', 'GET', '/bags/%s/tiddlers/local' % BENCH_BAG),
+    ('upstream_miss', 'GET', '/bags/%s/tiddlers/remote-%%d' % BENCH_BAG),
+    ('put', 'PUT', '/bags/%s/tiddlers/written-%%d' % BENCH_BAG),
+    ('delete', 'DELETE', '/bags/%s/tiddlers/written-%%d' % BENCH_BAG),
+]
+
+
+class FakeUpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer like a TiddlyWeb server would, after waiting for
+    the server's latency: GETs with the server's payload and
+    an ETag, writes with 204.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        payload = self.server.payload
+        etag = '"%s"' % hashlib.md5(self.path + payload).hexdigest()
+        if self.headers.get('if-none-match') == etag:
+            self._reply(304, '', [('ETag', etag)])
+        else:
+            self._reply(200, payload, [('Content-Type', 'application/json'),
+                ('ETag', etag)])
+
+    def do_PUT(self):
+        length = int(self.headers.get('content-length') or 0)
+        self.rfile.read(length)
+        time.sleep(self.server.latency)
+        self._reply(204)
+
+    do_POST = do_PUT
+
+    def do_DELETE(self):
+        time.sleep(self.server.latency)
+        self._reply(204)
+
+    def _reply(self, code, body='', headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+
+class FakeUpstream(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A stand in TiddlyWeb server, run in a background thread,
+    listening on an unused port on localhost.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, payload_size=1024):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                FakeUpstreamHandler)
+        self.latency = latency
+        self.payload = make_payload(payload_size)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def uri(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_payload(size):
+    """
+    A JSON string of roughly size bytes.
+    """
+    return json.dumps({'title': 'bench', 'text': 'x' * max(size - 30, 0)})
+
+
+def make_fixture(directory, target_server, port, payload_size):
+    """
+    Fill directory with an app for serve to use: an index.html,
+    assets for the local scenarios and a .tsapp pointing at
+    target_server.
+    """
+    payload = make_payload(payload_size)
+    os.mkdir(os.path.join(directory, 'assets'))
+    for name in ['index.html', os.path.join('assets', 'app.js'),
+            os.path.join('assets', 'local')]:
+        fixture_file = open(os.path.join(directory, name), 'w')
+        fixture_file.write(payload)
+        fixture_file.close()
+    config_file = open(os.path.join(directory, '.tsapp'), 'w')
+    config_file.write('target_server:%s\nlocal_host:127.0.0.1\nport:%s\n'
+            % (target_server, port))
+    config_file.close()
+
+
+def start_serve(directory, port):
+    """
+    Start `tsapp serve` in directory as a subprocess and wait
+    until it accepts connections.
+    """
+    package_root = os.path.dirname(os.path.dirname(
+        os.path.abspath(tsapp.__file__)))
+    env = dict(os.environ, HOME=directory, PYTHONPATH=package_root)
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen([sys.executable, '-c',
+        'from tsapp import handle; handle(["serve"])'],
+        cwd=directory, env=env, stdout=devnull, stderr=devnull)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise IOError('tsapp serve exited with %s' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    process.terminate()
+    raise IOError('tsapp serve did not start listening on %s' % port)
+
+
+def free_port():
+    """
+    An unused port on localhost.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class LoadResult(object):
+    """
+    Latencies, statuses and errors gathered while running load.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, status=None, error=None):
+        self._lock.acquire()
+        try:
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+            else:
+                self.statuses[status] += 1
+        finally:
+            self._lock.release()
+
+
+def run_load(host, port, next_request, concurrency=10, count=None,
+        duration=None):
+    """
+    Issue requests against host:port from concurrency threads, each
+    on its own keep-alive connection, until count requests have been
+    made or duration seconds have passed. next_request is called with
+    the request number and returns (method, path, body, headers), or
+    None when there are no more. Return a LoadResult.
+    """
+    result = LoadResult()
+    counter = itertools.count()
+    deadline = duration and time.time() + duration
+
+    def client():
+        connection = httplib.HTTPConnection(host, port, timeout=30)
+        while True:
+            number = next(counter)
+            if count is not None and number >= count:
+                break
+            if deadline and time.time() >= deadline:
+                break
+            request = next_request(number)
+            if request is None:
+                break
+            method, path, body, headers = request
+            start = time.time()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                result.record(time.time() - start, status=response.status)
+                if response.will_close:
+                    connection.close()
+            except (socket.error, httplib.HTTPException), exc:
+                result.record(time.time() - start,
+                        error=exc.__class__.__name__)
+                connection.close()
+                connection = httplib.HTTPConnection(host, port, timeout=30)
+        connection.close()
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+    result.elapsed = time.time() - start
+    return result
+
+
+def percentile(ordered, fraction):
+    """
+    The nearest rank percentile of the sorted list ordered.
+    """
+    if not ordered:
+        return 0
+    index = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(index, 0)]
+
+
+def summarize(name, result):
+    """
+    A dict of the numbers worth reporting from a LoadResult,
+    with latencies in milliseconds.
+    """
+    ordered = sorted(result.latencies)
+    requests = len(ordered)
+    return {
+        'scenario': name,
+        'requests': requests,
+        'errors': sum(result.errors.values()),
+        'error_types': dict(result.errors),
+        'statuses': dict((str(status), number)
+            for status, number in result.statuses.items()),
+        'elapsed': round(result.elapsed, 3),
+        'rps': round(requests / result.elapsed, 1) if result.elapsed else 0,
+        'mean_ms': round(1000 * sum(ordered) / requests, 2) if requests else 0,
+        'p50_ms': round(1000 * percentile(ordered, 0.50), 2),
+        'p95_ms': round(1000 * percentile(ordered, 0.95), 2),
+        'p99_ms': round(1000 * percentile(ordered, 0.99), 2),
+    }
+
+
+def print_report(summaries):
+    """
+    Print summaries as a table.
+    """
+    print '%-14s %8s %7s %10s %9s %9s %9s' % ('scenario', 'requests',
+            'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    for summary in summaries:
+        print ('%(scenario)-14s %(requests)8d %(errors)7d %(rps)10.1f '
+                '%(p50_ms)9.2f %(p95_ms)9.2f %(p99_ms)9.2f' % summary)
+
+
+def scenario_requests(method, path, payload, offset=0):
+    """
+    Return a next_request function for run_load making requests
+    for one scenario. A %d in path is filled with the request
+    number plus offset, so every request goes to a different tiddler.
+    """
+    def next_request(number):
+        if '%d' in path:
+            target = path % (number + offset)
+        else:
+            target = path
+        if method in ('PUT', 'POST'):
+            return method, target, payload, {
+                    'Content-Type': 'application/json'}
+        return method, target, None, {'Accept': 'application/json'}
+    return next_request
+
+
+def run_bench(scenarios=None, concurrency=10, count=1000, duration=None,
+        latency=0, payload_size=1024):
+    """
+    Run the named scenarios (default all) against a freshly
+    started serve and return a list of summaries.
+    """
+    upstream = FakeUpstream(latency=latency, payload_size=payload_size)
+    upstream.start()
+    directory = tempfile.mkdtemp(prefix='tsapp-bench')
+    port = free_port()
+    process = None
+    try:
+        make_fixture(directory, upstream.uri, port, payload_size)
+        process = start_serve(directory, port)
+        payload = make_payload(payload_size)
+        summaries = []
+        for name, method, path in SCENARIOS:
+            if scenarios and name not in scenarios:
+                continue
+            # warm up connections and threads without recording
+            run_load('127.0.0.1', port,
+                    scenario_requests(method, path, payload, offset=10 ** 9),
+                    concurrency=concurrency, count=concurrency * 2)
+            result = run_load('127.0.0.1', port,
+                    scenario_requests(method, path, payload),
+                    concurrency=concurrency, count=count, duration=duration)
+            summaries.append(summarize(name, result))
+        return summaries
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        upstream.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_metadata(options):
+    """
+    What was benchmarked, to go with machine readable results.
+    """
+    return {
+        'tsapp_version': tsapp.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options': options,
+    }
@@ -0,0 +1,154 @@
+"""
+In memory cache of GET responses from the target server.
+
+Entries are only made for responses with an ETag. Once an entry
+is older than the configured ttl it is revalidated with the target
+server using If-None-Match before it is used again.
+
+If cache_dir is set in config, the in memory cache is backed by a
+tsapp.diskcache.DiskCache there.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class CachedResponse(object):
+    """
+    The parts of an upstream response needed to serve it again.
+    body is as it came from the server, still encoded if it
+    was sent with a Content-Encoding.
+    """
+
+    def __init__(self, status, mime_type, etag, body, encoding=None,
+            vary=None):
+        self.status = status
+        self.mime_type = mime_type
+        self.etag = etag
+        self.body = body
+        self.encoding = encoding
+        self.vary = vary
+        self.stored = time.time()
+
+
+class ResponseCache(object):
+    """
+    A least recently used cache of CachedResponses, holding at most
+    max_entries of them and max_bytes of body. A single body larger
+    than a tenth of max_bytes is not cached.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 10
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the entry for key, or None, marking it as recently used.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def put(self, key, entry):
+        """
+        Store entry under key, evicting the least recently used
+        entries to make room. Entries that are too big are ignored.
+        """
+        if len(entry.body) > self.max_entry_bytes:
+            return
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self._entries[key] = entry
+            self.size += len(entry.body)
+            while (len(self._entries) > self.max_entries
+                    or self.size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+        finally:
+            self._lock.release()
+
+    def is_fresh(self, entry):
+        """
+        True if entry may be used without revalidating it.
+        """
+        return time.time() - entry.stored < self.ttl
+
+    def refresh(self, key, entry):
+        """
+        Mark entry, stored under key, as just revalidated.
+        """
+        entry.stored = time.time()
+
+
+class TieredCache(ResponseCache):
+    """
+    A ResponseCache backed by a second, larger and slower, cache
+    such as a DiskCache. Entries are put in both, and those found
+    only in the second are copied into memory as they are used.
+    """
+
+    def __init__(self, second, max_entries=1000,
+            max_bytes=16 * 1024 * 1024, ttl=0):
+        ResponseCache.__init__(self, max_entries, max_bytes, ttl)
+        self.second = second
+
+    def get(self, key):
+        entry = ResponseCache.get(self, key)
+        if entry is None:
+            entry = self.second.get(key)
+            if entry is not None:
+                ResponseCache.put(self, key, entry)
+        return entry
+
+    def put(self, key, entry):
+        ResponseCache.put(self, key, entry)
+        self.second.put(key, entry)
+
+    def refresh(self, key, entry):
+        ResponseCache.refresh(self, key, entry)
+        self.second.refresh(key, entry)
+
+
+def create_cache(config):
+    """
+    Return a ResponseCache configured from config, or None
+    if cache_entries is 0. It is a TieredCache, in front of
+    a DiskCache in cache_dir, if that is set.
+    """
+    max_entries = int(config.get('cache_entries', 1000))
+    if not max_entries:
+        return None
+    max_bytes = int(config.get('cache_bytes', 16 * 1024 * 1024))
+    ttl = float(config.get('cache_ttl', 0))
+    directory = config.get('cache_dir')
+    if directory:
+        from .diskcache import DiskCache
+        disk = DiskCache(directory,
+                max_bytes=int(config.get('cache_dir_bytes',
+                    256 * 1024 * 1024)),
+                max_entry_bytes=max_bytes // 10, ttl=ttl)
+        return TieredCache(disk, max_entries=max_entries,
+                max_bytes=max_bytes, ttl=ttl)
+    return ResponseCache(max_entries=max_entries, max_bytes=max_bytes,
+            ttl=ttl)
@@ -0,0 +1,98 @@
+"""
+Coalesce identical concurrent calls, so only one does the work.
+"""
+
+import threading
+
+
+class _Call(object):
+    """
+    A call in progress, which others with the same key wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Run one call at a time for each key. Callers arriving with a key
+    whose call is in progress wait for it and share its result, or
+    have its exception raised in turn.
+
+    leaders counts the calls made, coalesced the callers which
+    shared one and errors the calls which failed. Responses
+    with bodies larger than max_bytes are not shared, see
+    tsapp.proxy.get_upstream, and oversize counts them.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.leaders = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.oversize = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """
+        Return (result, shared): the result of calling function, or
+        of the call in progress for key, and whether it was another
+        caller's.
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except Exception, exc:
+            call.error = exc
+            self.errors += 1
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
+        return call.result, False
+
+    @property
+    def in_flight(self):
+        """
+        The number of calls in progress.
+        """
+        return len(self._calls)
+
+
+def create_flights(config):
+    """
+    Return a SingleFlight configured from config, or None if
+    coalesce_bytes is 0.
+    """
+    max_bytes = int(config.get('coalesce_bytes', 1024 * 1024))
+    if not max_bytes:
+        return None
+    return SingleFlight(max_bytes)
@@ -0,0 +1,80 @@
+"""
+gzip content coding helpers.
+"""
+
+import zlib
+
+
+# Types worth compressing. Everything else (images, fonts, video)
+# is already compressed or too small to matter.
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+)
+
+# Below this many bytes compression is not worth the overhead.
+MIN_COMPRESS_SIZE = 256
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def is_compressible(mime_type):
+    """
+    True if content of mime_type is worth compressing.
+    """
+    return bool(mime_type) and mime_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepts_gzip(environ):
+    """
+    True if the request's Accept-Encoding allows gzip.
+    """
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Yield the gzip compressed form of the iterable of str chunks.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gunzip_chunks(chunks):
+    """
+    Yield the decompressed form of the iterable of gzip
+    compressed str chunks, closing chunks at the end if it
+    can be closed.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
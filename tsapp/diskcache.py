@@ -0,0 +1,284 @@
+"""
+On disk cache of GET responses from the target server, kept behind
+the in memory cache so that responses outlive a restart of serve and
+are shared between serve processes using the same directory.
+
+Bodies are stored once each, by their SHA1, under blobs/. Each
+cached response has a small JSON file under index/, named by a
+hash of its key, giving the blob along with the status, headers
+and time it was fetched. Both are written to a temporary file and
+renamed into place, so a reader never sees half of one. Writers
+hold a shared lock on the directory's lock file and eviction an
+exclusive one, so a blob is never removed between being written
+and being indexed. Cached bodies may come from private bags, so
+the directory and everything in it is readable only by its owner.
+
+When the blobs exceed max_bytes the least recently used entries,
+by the mtime of their index file, are removed until they take up
+no more than nine tenths of it.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .cache import CachedResponse
+
+
+# Fields of a CachedResponse kept in its index file.
+FIELDS = ('status', 'mime_type', 'etag', 'encoding', 'vary', 'stored')
+
+# Temporary files older than this, in seconds, are left from a
+# crash and are removed when evicting.
+STALE_TEMP_AGE = 60
+
+
+class DiskCache(object):
+    """
+    CachedResponses stored in directory, at most max_bytes of body
+    in all and max_entry_bytes each, used without revalidating for
+    ttl seconds after they were fetched.
+
+    Safe to share between threads and processes.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024,
+            max_entry_bytes=None, ttl=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 10
+        self.ttl = ttl
+        self.blobs = os.path.join(directory, 'blobs')
+        self.index = os.path.join(directory, 'index')
+        for path in (self.blobs, self.index):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path, 0700)
+                except OSError, exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+        self.lock_path = os.path.join(directory, 'lock')
+        self.loads = 0
+        self.size = sum(size for _, size in self._blob_sizes())
+
+    def get(self, key):
+        """
+        Return the CachedResponse for key, or None, marking it
+        as recently used.
+        """
+        index_path = self._index_path(key)
+        try:
+            index_file = open(index_path)
+            try:
+                record = json.load(index_file)
+            finally:
+                index_file.close()
+            blob_file = open(self._blob_path(record['blob']), 'rb')
+            try:
+                body = blob_file.read()
+            finally:
+                blob_file.close()
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        if hashlib.sha1(body).hexdigest() != record['blob']:
+            return None
+        try:
+            os.utime(index_path, None)
+        except OSError:
+            pass
+
+        # JSON gives back unicode, WSGI wants native strings
+        record = dict((name, _native(value))
+                for name, value in record.items())
+        entry = CachedResponse(record['status'], record['mime_type'],
+                record['etag'], body, record['encoding'], record['vary'])
+        entry.stored = record['stored']
+        self.loads += 1
+        return entry
+
+    def put(self, key, entry):
+        """
+        Store entry under key, evicting the least recently used
+        entries if that takes the cache over max_bytes. Entries that
+        are too big are ignored.
+        """
+        if len(entry.body) > self.max_entry_bytes:
+            return
+        digest = hashlib.sha1(entry.body).hexdigest()
+        record = dict((field, getattr(entry, field)) for field in FIELDS)
+        record['blob'] = digest
+
+        lock = self._lock(exclusive=False)
+        try:
+            blob_path = self._blob_path(digest)
+            if not os.path.exists(blob_path):
+                _write_file(blob_path, entry.body)
+                self.size += len(entry.body)
+            _write_file(self._index_path(key), json.dumps(record))
+        finally:
+            _unlock(lock)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def refresh(self, key, entry):
+        """
+        Record that entry, stored under key, was just revalidated.
+
+        Only the time in its index file is updated, the body is left
+        alone. Without a ttl the time is never used, as entries are
+        always revalidated, so nothing is written at all.
+        """
+        entry.stored = time.time()
+        if not self.ttl:
+            return
+        index_path = self._index_path(key)
+        lock = self._lock(exclusive=False)
+        try:
+            try:
+                index_file = open(index_path)
+                try:
+                    record = json.load(index_file)
+                finally:
+                    index_file.close()
+            except (IOError, OSError, ValueError):
+                # evicted meanwhile, there is nothing to update
+                return
+            record['stored'] = entry.stored
+            _write_file(index_path, json.dumps(record))
+        finally:
+            _unlock(lock)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the blobs take
+        no more than nine tenths of max_bytes, then the blobs and
+        temporary files no entry needs.
+        """
+        lock = self._lock(exclusive=True)
+        try:
+            sizes = dict(self._blob_sizes())
+            entries = []
+            references = {}
+            for path in _files(self.index):
+                try:
+                    index_file = open(path)
+                    try:
+                        digest = json.load(index_file)['blob']
+                    finally:
+                        index_file.close()
+                    used = os.stat(path).st_mtime
+                except (IOError, OSError, ValueError, KeyError):
+                    _remove(path)
+                    continue
+                entries.append((used, path, digest))
+                references[digest] = references.get(digest, 0) + 1
+
+            size = sum(sizes.get(digest, 0) for digest in references)
+            target = self.max_bytes * 9 // 10
+            entries.sort()
+            for _, path, digest in entries:
+                if size <= target:
+                    break
+                _remove(path)
+                references[digest] -= 1
+                if not references[digest]:
+                    size -= sizes.get(digest, 0)
+
+            for digest in sizes:
+                if not references.get(digest):
+                    _remove(self._blob_path(digest))
+            self.size = size
+
+            now = time.time()
+            for path in _files(self.directory, temporary=True):
+                try:
+                    if now - os.stat(path).st_mtime > STALE_TEMP_AGE:
+                        _remove(path)
+                except OSError:
+                    pass
+        finally:
+            _unlock(lock)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def _index_path(self, key):
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.index, digest[:2], digest + '.json')
+
+    def _blob_sizes(self):
+        for path in _files(self.blobs):
+            try:
+                yield os.path.basename(path), os.path.getsize(path)
+            except OSError:
+                pass
+
+    def _lock(self, exclusive):
+        """
+        Take a lock on the cache directory, exclusive or shared.
+        """
+        if fcntl is None:
+            return None
+        lock = open(self.lock_path, 'a')
+        fcntl.flock(lock, exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+        return lock
+
+
+def _native(value):
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    return value
+
+
+def _unlock(lock):
+    if lock is not None:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def _write_file(path, data):
+    """
+    Write data to the file at path, replacing it in a single rename.
+    The file is left readable only by its owner, as mkstemp makes it.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.mkdir(directory, 0700)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+    handle, temp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+    temp_file = os.fdopen(handle, 'wb')
+    try:
+        temp_file.write(data)
+    finally:
+        temp_file.close()
+    os.rename(temp_path, path)
+
+
+def _files(directory, temporary=False):
+    """
+    The paths of the files in directory and below, either the
+    temporary ones or the rest.
+    """
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.startswith('.tmp') == temporary and name != 'lock':
+                yield os.path.join(root, name)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
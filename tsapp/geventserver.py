@@ -0,0 +1,45 @@
+"""
+Start a gevent based web server to host the proxy.
+
+Use it by setting wsgi_server to tsapp.geventserver in config.
+Each request is handled in a greenlet instead of a thread, and the
+standard library is monkey patched so that while a request waits
+on the target server, through urllib2 as usual, others carry on.
+Many slow upstream requests can then be in progress at once
+without a thread for each.
+"""
+
+from __future__ import absolute_import
+
+try:
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+except ImportError:
+    from tsapp import error_exit
+    error_exit(1, 'tsapp.geventserver requires gevent: pip install gevent')
+
+import sys
+
+from .proxy import create_app
+
+
+def start_server(config):
+    """
+    Make a server and run it until interrupted. At most
+    gevent_connections requests are handled at once.
+    """
+    port = int(config['port'])
+    local_host = config['local_host']
+    connections = int(config.get('gevent_connections', 10000))
+
+    # The proxy's Log writes the access log, in the usual format.
+    server = WSGIServer((local_host, port), create_app(config),
+            spawn=Pool(connections), log=None)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+        sys.exit(0)
@@ -1,12 +1,28 @@
 """
 HTTP fundamentals.
+
+Every request to a target server, from push, delete, pull or the
+serve proxy, goes through open_request and so through one
+ClientPolicy: an optional rate limit per host, a cap on how many
+requests a host is sent at once which shrinks when the host says
+it is overloaded and grows back as requests succeed, and retries
+with backoff for idempotent requests which fail that way.
 """
 
+import email.utils
+import httplib
 import mimetypes
+import os
+import random
+import socket
 import sys
+import threading
+import time
 import urllib2
 import urllib
 
+from .metrics import UPSTREAM_REQUESTS, UPSTREAM_DURATION, UPSTREAM_RETRIES
+
 
 mimetypes.add_type('text/plain', '.tid')
 mimetypes.add_type('application/x-woff', '.woff')
@@ -14,6 +30,15 @@ mimetypes.add_type('application/octet-stream', '.ttf')
 mimetypes.add_type('application/vnd.ms-fontobject', '.eot')
 mimetypes.add_type('image/svg+xml', '.svg')
 
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+CHUNK_SIZE = 65536
+
+# Methods which can safely be sent again, and the statuses
+# (with 'error' for no response at all) meaning a host is
+# overloaded or unavailable and a retry may work.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUSES = (429, 502, 503, 504, 'error')
+
 
 class NoRedirect(urllib2.HTTPRedirectHandler):
     """
@@ -23,22 +48,532 @@ class NoRedirect(urllib2.HTTPRedirectHandler):
         pass
 
 
+class BodyReader(object):
+    """
+    A request body made of the next length bytes of filehandle,
+    sent in chunks of CHUNK_SIZE so that no more than that is in
+    memory at once, however large the body.
+    """
+
+    def __init__(self, filehandle, length):
+        self.filehandle = filehandle
+        self.length = length
+        self.remaining = length
+        try:
+            self.start = filehandle.tell()
+        except (AttributeError, IOError):
+            self.start = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while self.remaining:
+            chunk = self.filehandle.read(min(self.remaining, CHUNK_SIZE))
+            if not chunk:
+                raise IOError('request body ended %s bytes early'
+                        % self.remaining)
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def rewind(self):
+        """
+        Go back to the start of the body so it can be sent again.
+        Return False if filehandle cannot seek.
+        """
+        if self.remaining == self.length:
+            return True
+        if self.start is None:
+            return False
+        self.filehandle.seek(self.start)
+        self.remaining = self.length
+        return True
+
+
+class ConnectionPool(object):
+    """
+    Idle HTTP/1.1 connections kept open for reuse, keyed by
+    (scheme, host, port). At most maxsize idle connections are
+    kept per key and any that have been idle for longer than
+    idle_timeout seconds are closed rather than reused.
+
+    Safe to share between threads: a connection is only ever
+    handed to one caller at a time.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=15):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return an idle connection for key, or None if there is none.
+        """
+        now = time.time()
+        stale = []
+        connection = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(candidate)
+                else:
+                    connection = candidate
+                    break
+        finally:
+            self._lock.release()
+        for candidate in stale:
+            candidate.close()
+        return connection
+
+    def put(self, key, connection):
+        """
+        Return a connection, whose last response has been completely
+        read, to the pool. It is closed if the pool for key is full.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((connection, time.time()))
+                connection = None
+        finally:
+            self._lock.release()
+        if connection:
+            connection.close()
+
+    def clear(self):
+        """
+        Close all the idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+
+class PooledResponse(object):
+    """
+    Wrap an httplib response so that its connection goes back to
+    the pool once the body has been completely read. If the response
+    is closed before then, the connection is closed too.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        if response.length == 0:
+            response.close()
+            self._release()
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self._release()
+        return data
+
+    recv = read
+
+    def close(self):
+        self.response.close()
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def _release(self):
+        if self.connection:
+            if self.response.will_close:
+                self.connection.close()
+            else:
+                self.pool.put(self.key, self.connection)
+            self.connection = None
+
+
+class PooledHandlerMixin(object):
+    """
+    Replacement for urllib2's do_open which takes connections from,
+    and returns them to, a ConnectionPool, and asks for them to be
+    kept alive.
+    """
+
+    def do_pooled_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        scheme = req.get_type()
+        hostname, port = urllib.splitport(host)
+        key = (scheme, hostname.lower(),
+                int(port or DEFAULT_PORTS.get(scheme, 80)))
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+
+        connection = self.pool.get(key)
+        if connection:
+            try:
+                response = self._send(connection, req, headers)
+            except (socket.error, httplib.HTTPException), err:
+                # the server may have dropped the idle connection,
+                # try again on a fresh one if the body can be resent
+                connection.close()
+                connection = None
+                if (isinstance(req.data, BodyReader)
+                        and not req.data.rewind()):
+                    raise urllib2.URLError(err)
+
+        if not connection:
+            connection = http_class(host, timeout=req.timeout,
+                    **http_conn_args)
+            connection.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                tunnel_headers = {}
+                proxy_auth_hdr = 'Proxy-Authorization'
+                if proxy_auth_hdr in headers:
+                    tunnel_headers[proxy_auth_hdr] = headers[proxy_auth_hdr]
+                    del headers[proxy_auth_hdr]
+                connection.set_tunnel(req._tunnel_host,
+                        headers=tunnel_headers)
+            try:
+                response = self._send(connection, req, headers)
+            except (socket.error, httplib.HTTPException), err:
+                connection.close()
+                raise urllib2.URLError(err)
+
+        pooled = PooledResponse(self.pool, key, connection, response)
+        fp = socket._fileobject(pooled, close=True)
+
+        resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send(self, connection, req, headers):
+        if connection.sock is None:
+            connection.connect()
+            # headers and body chunks are separate writes, don't let
+            # Nagle hold them back waiting for a delayed ACK
+            connection.sock.setsockopt(socket.IPPROTO_TCP,
+                    socket.TCP_NODELAY, 1)
+        if isinstance(req.data, BodyReader):
+            connection.request(req.get_method(), req.get_selector(),
+                    None, headers)
+            for chunk in req.data:
+                connection.send(chunk)
+        else:
+            connection.request(req.get_method(), req.get_selector(),
+                    req.data, headers)
+        return connection.getresponse(buffering=True)
+
+
+class PooledHTTPHandler(PooledHandlerMixin, urllib2.HTTPHandler):
+    """
+    HTTP handler using keep-alive connections from pool.
+    """
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_pooled_open(httplib.HTTPConnection, req)
+
+
+class PooledHTTPSHandler(PooledHandlerMixin, urllib2.HTTPSHandler):
+    """
+    HTTPS handler using keep-alive connections from pool.
+    """
+
+    def __init__(self, pool, debuglevel=0, context=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.do_pooled_open(httplib.HTTPSConnection, req,
+                context=self._context)
+
+
+class TokenBucket(object):
+    """
+    Allow rate requests a second on average, in bursts of up
+    to burst at once.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Wait until a request is allowed.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+
+class ConcurrencyLimit(object):
+    """
+    An adaptive cap on the requests in flight to one host.
+
+    It starts at maximum, or uncapped if maximum is 0, is halved
+    from the number in flight when the host fails a request as
+    overloaded, and grows by about one for each round of requests
+    that succeed (additive increase, multiplicative decrease).
+    A request is in flight until its response headers arrive.
+    """
+
+    def __init__(self, maximum=0, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum or None
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        self._condition.acquire()
+        try:
+            while self.limit is not None and self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        finally:
+            self._condition.release()
+
+    def release(self, overloaded=False):
+        self._condition.acquire()
+        try:
+            if overloaded:
+                self.limit = max(self.minimum,
+                        (self.limit or self.in_flight) / 2.0)
+            elif self.limit is not None:
+                self.limit += 1.0 / self.limit
+                if self.maximum and self.limit > self.maximum:
+                    self.limit = self.maximum
+            self.in_flight -= 1
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+
+class ClientPolicy(object):
+    """
+    How requests are made to each host: at most rate a second
+    (if rate is set) through a TokenBucket, with at most concurrency
+    in flight at once (0 for no fixed cap) through a ConcurrencyLimit,
+    and idempotent requests retried up to retries times.
+
+    The wait before retry n (from 0) is a random time up to
+    backoff * 2 ** n seconds, or what the host asked for with
+    Retry-After if longer. No wait is longer than max_delay: a
+    request the host wants left for longer is not retried.
+    """
+
+    def __init__(self, rate=0, burst=None, concurrency=0, retries=3,
+            backoff=0.5, max_delay=10):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, key):
+        """
+        The (TokenBucket or None, ConcurrencyLimit) for key.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                return self._hosts[key]
+            except KeyError:
+                bucket = None
+                if self.rate:
+                    bucket = TokenBucket(self.rate, self.burst)
+                limits = self._hosts[key] = (bucket,
+                        ConcurrencyLimit(self.concurrency))
+                return limits
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Forget the state of each host, so changes in settings apply.
+        """
+        self._lock.acquire()
+        try:
+            self._hosts = {}
+        finally:
+            self._lock.release()
+
+    def retry_delay(self, req, attempt, error):
+        """
+        Seconds to wait before trying req again after it failed
+        with error, on attempt (from 0), or None if it should not be.
+        """
+        if attempt >= self.retries:
+            return None
+        if req.get_method() not in IDEMPOTENT_METHODS:
+            return None
+        if isinstance(req.data, BodyReader) and not req.data.rewind():
+            return None
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if isinstance(error, urllib2.HTTPError):
+            retry_after = parse_retry_after(error.info().get('Retry-After'))
+            if retry_after is not None:
+                if retry_after > self.max_delay:
+                    return None
+                delay = max(delay, retry_after)
+        return min(delay, self.max_delay)
+
+
+def parse_retry_after(value):
+    """
+    Seconds from now given by a Retry-After header, which is
+    either a number of seconds or an HTTP date, or None.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+POOL = ConnectionPool()
+POLICY = ClientPolicy()
+OPENER = urllib2.build_opener(NoRedirect(), PooledHTTPHandler(POOL),
+        PooledHTTPSHandler(POOL))
+REDIRECT_OPENER = urllib2.build_opener(PooledHTTPHandler(POOL),
+        PooledHTTPSHandler(POOL))
+
+
+def configure(config):
+    """
+    Set the connection pool limits and the client policy from config.
+    """
+    POOL.maxsize = int(config.get('pool_connections', POOL.maxsize))
+    POOL.idle_timeout = float(config.get('pool_idle_timeout',
+        POOL.idle_timeout))
+    POLICY.rate = float(config.get('upstream_rate', POLICY.rate))
+    POLICY.burst = int(config.get('upstream_burst', POLICY.burst or 0))
+    POLICY.concurrency = int(config.get('upstream_concurrency',
+        POLICY.concurrency))
+    POLICY.retries = int(config.get('upstream_retries', POLICY.retries))
+    POLICY.backoff = float(config.get('upstream_retry_backoff',
+        POLICY.backoff))
+    POLICY.max_delay = float(config.get('upstream_retry_max_delay',
+        POLICY.max_delay))
+    POLICY.clear()
+
+
+def open_request(req, redirect=False):
+    """
+    Open the urllib2 Request req over a pooled connection, as
+    POLICY allows, retrying if it fails and may be retried.
+    Redirects are only followed if redirect is True.
+
+    The time taken and the status of each attempt, and the
+    retries, are recorded in tsapp.metrics.
+    """
+    method = req.get_method()
+    bucket, limit = POLICY.host((req.get_type(), req.get_host()))
+    attempt = 0
+    while True:
+        if bucket:
+            bucket.take()
+        limit.acquire()
+        status = 'error'
+        error = None
+        start = time.time()
+        try:
+            if redirect:
+                response = REDIRECT_OPENER.open(req)
+            else:
+                response = OPENER.open(req)
+            status = response.getcode()
+        except urllib2.HTTPError, exc:
+            status = exc.getcode()
+            error = exc
+        except urllib2.URLError, exc:
+            error = exc
+        finally:
+            limit.release(overloaded=status in RETRY_STATUSES)
+            UPSTREAM_DURATION.observe(time.time() - start, (method,))
+            UPSTREAM_REQUESTS.inc((method, status))
+
+        if error is None:
+            return response
+        delay = None
+        if status in RETRY_STATUSES:
+            delay = POLICY.retry_delay(req, attempt, error)
+        if delay is None:
+            raise error
+        if isinstance(error, urllib2.HTTPError):
+            error.close()
+        sys.stderr.write('%s %s failed with %s, retrying in %.1fs\n'
+                % (method, req.get_full_url(), status, delay))
+        UPSTREAM_RETRIES.inc((method,))
+        time.sleep(delay)
+        attempt += 1
+
+
 def http_write(method='PUT', uri=None, auth_token=None, filehandle=None,
-        filename=None, mime_type=None, data=None, count=None):
+        filename=None, mime_type=None, data=None, count=None,
+        content_encoding=None):
     """
     Do an HTTP write method. As you can see from the method
     signature this is attempting to generalize a lot of different
     ways of being called. Which is dumb, but it is working for now.
-    """
-    opener = urllib2.build_opener(NoRedirect())
 
+    A body from filename or filehandle is streamed to the server
+    rather than read into memory. If count is not given it is
+    the size of filehandle's file.
+    """
     if filename and method is not 'DELETE':
-        filehandle = open(filename)
         mime_type = mimetypes.guess_type(filename, strict=False)[0]
         if not mime_type:
             sys.stderr.write('Unable to guess mime type for %s, skipping!\n'
                     % filename)
             return None, None
+        filehandle = open(filename, 'rb')
+        try:
+            return http_write(method=method, uri=uri, auth_token=auth_token,
+                    filehandle=filehandle, mime_type=mime_type)
+        finally:
+            filehandle.close()
 
     req = urllib2.Request(uri.encode('utf-8'))
 
@@ -47,19 +582,22 @@ def http_write(method='PUT', uri=None, auth_token=None, filehandle=None,
 
     if method is not 'DELETE':
         req.add_header('Content-Type', mime_type)
+    if content_encoding:
+        req.add_header('Content-Encoding', content_encoding)
 
     req.get_method = lambda: method
-    if count:
-        req.add_data(filehandle.read(count))
-    elif filehandle:
-        req.add_data(filehandle.read())
+    if filehandle:
+        if count is None:
+            count = os.fstat(filehandle.fileno()).st_size
+        req.add_header('Content-Length', '%d' % count)
+        req.add_data(BodyReader(filehandle, count))
     elif data:
         data = urllib.urlencode(data)
         req.add_data(data)
 
     # a non 20x response on this will raise an exception expected
     # to be handled by the caller
-    response = opener.open(req)
+    response = open_request(req)
 
     mime_type = response.info().gettype()
     return response, mime_type
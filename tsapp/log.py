@@ -0,0 +1,161 @@
+"""
+Writers for the access log kept by the proxy's Log middleware.
+
+Records are either formatted and written as they arrive, or put
+on a bounded queue and formatted and written in batches by a
+background thread, so a slow sink does not hold up requests.
+"""
+
+import atexit
+import Queue
+import sys
+import threading
+import time
+
+
+LOG_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S '
+
+_TIME_CACHE = (None, None)
+_STOP = object()
+
+
+def log_time(timestamp):
+    """
+    Format timestamp for the log. The result is reused for
+    every record logged within the same second.
+    """
+    global _TIME_CACHE
+    second = int(timestamp)
+    cached_second, formatted = _TIME_CACHE
+    if cached_second != second:
+        formatted = time.strftime(LOG_TIME_FORMAT, time.localtime(second))
+        _TIME_CACHE = (second, formatted)
+    return formatted
+
+
+class StreamSink(object):
+    """
+    Write log messages to a file like object.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, messages):
+        self.stream.write(''.join('%s\n' % message for message in messages))
+        self.stream.flush()
+
+
+class SyslogSink(object):
+    """
+    Write log messages to the system log.
+    """
+
+    def __init__(self):
+        import syslog
+        self.syslog = syslog
+        syslog.openlog('tsapp', 0, syslog.LOG_USER)
+
+    def write(self, messages):
+        for message in messages:
+            self.syslog.syslog(self.syslog.LOG_INFO, message)
+
+
+class SyncLogWriter(object):
+    """
+    Format and write each record in the calling thread.
+    """
+
+    def __init__(self, sink, formatter):
+        self.sink = sink
+        self.formatter = formatter
+
+    def write(self, record):
+        self.sink.write([self.formatter(record)])
+
+
+class AsyncLogWriter(object):
+    """
+    Queue records for a background thread which formats them and
+    writes them to sink up to batch_size at a time.
+
+    The queue holds at most queue_size records. When it is full
+    a record is dropped and counted, or if block is True the
+    caller waits for room. Drops are reported on stderr.
+    """
+
+    def __init__(self, sink, formatter, queue_size=10000, block=False,
+            batch_size=256):
+        self.sink = sink
+        self.formatter = formatter
+        self.block = block
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._reported = 0
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        if self.block:
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except Queue.Full:
+                self.dropped += 1
+
+    def close(self, timeout=2):
+        """
+        Write out what is queued and stop the thread.
+        """
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            messages = [self.formatter(record) for record in records
+                    if record is not _STOP]
+            try:
+                if messages:
+                    self.sink.write(messages)
+            except Exception, exc:
+                sys.stderr.write('unable to write log: %s\n' % exc)
+            if self.dropped != self._reported:
+                sys.stderr.write('log queue full, %s records dropped\n'
+                        % (self.dropped - self._reported))
+                self._reported = self.dropped
+            if _STOP in records:
+                return
+
+
+def create_log_writer(config, formatter):
+    """
+    Make the log writer described by config. log_sink is "-" for
+    stdout, "syslog", or the path of a file to append to. If
+    log_async is set records are written by a background thread.
+    """
+    sink_name = config.get('log_sink', '-')
+    if sink_name == '-':
+        sink = StreamSink(sys.stdout)
+    elif sink_name == 'syslog':
+        sink = SyslogSink()
+    else:
+        sink = StreamSink(open(sink_name, 'a'))
+
+    if config.get('log_async'):
+        return AsyncLogWriter(sink, formatter,
+                queue_size=int(config.get('log_queue_size', 10000)),
+                block=config.get('log_queue_full', 'drop') == 'block')
+    return SyncLogWriter(sink, formatter)
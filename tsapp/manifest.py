@@ -0,0 +1,80 @@
+"""
+Keep track of what has already been pushed, so unchanged
+files can be skipped.
+
+The manifest lives in ./.tsapp_manifest as JSON. It is divided into
+sections, one per target tiddlers collection (that is per server
+and bag), each mapping a local path to the hash, size and mtime
+the file had when it was last pushed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+
+MANIFEST_FILE = '.tsapp_manifest'
+
+
+def load_manifest():
+    """
+    Read the manifest from the local dir. A missing or
+    unreadable manifest is treated as empty.
+    """
+    try:
+        manifest_file = open(MANIFEST_FILE)
+    except IOError:
+        return {}
+    try:
+        try:
+            return json.load(manifest_file)
+        except ValueError:
+            return {}
+    finally:
+        manifest_file.close()
+
+
+def save_manifest(manifest):
+    """
+    Write the manifest to the local dir, replacing the
+    old one in a single rename.
+    """
+    handle, temp_path = tempfile.mkstemp(prefix=MANIFEST_FILE, dir='.')
+    temp_file = os.fdopen(handle, 'w')
+    try:
+        json.dump(manifest, temp_file, indent=1, sort_keys=True)
+    finally:
+        temp_file.close()
+    os.rename(temp_path, MANIFEST_FILE)
+
+
+def file_state(path, known=None):
+    """
+    Return a dict of the hash, size and mtime of the file at path.
+
+    If known, a previous state, has the same size and mtime the
+    file is assumed unchanged and its hash is not recomputed.
+    """
+    stat = os.stat(path)
+    state = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if (known and known.get('size') == state['size']
+            and known.get('mtime') == state['mtime']):
+        state['hash'] = known.get('hash')
+    else:
+        state['hash'] = _hash_file(path)
+    return state
+
+
+def _hash_file(path):
+    """
+    SHA1 of the content of the file at path.
+    """
+    digest = hashlib.sha1()
+    source = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: source.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        source.close()
+    return digest.hexdigest()
@@ -0,0 +1,203 @@
+"""
+Counters and histograms for serve, shown in the Prometheus text
+format at /_tsapp/metrics.
+
+Metrics are kept in a module level REGISTRY, so any module can
+update them. Each update takes one short, rarely contended, lock.
+Worker processes (see server_processes) each have their own.
+"""
+
+import bisect
+import threading
+
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1, 2.5, 5, 10)
+
+
+class Metric(object):
+    """
+    A named family of values, one for each combination of
+    label values.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        The lines of text format describing this metric.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                '# TYPE %s %s' % (self.name, self.kind)]
+        self._lock.acquire()
+        try:
+            values = sorted(self._values.items())
+        finally:
+            self._lock.release()
+        for label_values, value in values:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name,
+            format_labels(self.labels, label_values), format_number(value))]
+
+
+class Counter(Metric):
+    """
+    A count which only goes up.
+    """
+
+    kind = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        self._lock.acquire()
+        try:
+            self._values[label_values] = (
+                    self._values.get(label_values, 0) + amount)
+        finally:
+            self._lock.release()
+
+
+class Gauge(Counter):
+    """
+    A value which goes up and down.
+    """
+
+    kind = 'gauge'
+
+    def dec(self, label_values=(), amount=1):
+        self.inc(label_values, -amount)
+
+
+class Histogram(Metric):
+    """
+    Observations counted in buckets by upper bound, with their
+    sum and count.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, label_values=()):
+        index = bisect.bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            try:
+                counts = self._values[label_values]
+            except KeyError:
+                # one per bucket, one for +Inf, then the sum
+                counts = self._values[label_values] = (
+                        [0] * (len(self.buckets) + 2))
+            counts[index] += 1
+            counts[-1] += value
+        finally:
+            self._lock.release()
+
+    def _render_value(self, label_values, counts):
+        lines = []
+        total = 0
+        bounds = [format_number(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, counts[:-1]):
+            total += count
+            lines.append('%s_bucket%s %s' % (self.name,
+                format_labels(self.labels + ('le',),
+                    label_values + (bound,)), total))
+        labels = format_labels(self.labels, label_values)
+        lines.append('%s_sum%s %s' % (self.name, labels,
+            format_number(counts[-1])))
+        lines.append('%s_count%s %s' % (self.name, labels, total))
+        return lines
+
+
+class Registry(object):
+    """
+    The metrics to render, in the order they were made.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self._add(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(),
+            buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def render(self, extra=()):
+        """
+        The text format of all the metrics, followed by extra,
+        a list of (name, kind, description, value) for values
+        kept elsewhere.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, kind, description, value in extra:
+            lines.extend(['# HELP %s %s' % (name, description),
+                '# TYPE %s %s' % (name, kind),
+                '%s %s' % (name, format_number(value))])
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+def format_labels(names, values):
+    """
+    {name="value",...} for the labels, or nothing if there are none.
+    """
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\',
+        '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values))
+
+
+def format_number(value):
+    """
+    value as it should appear in the text format.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter('tsapp_requests_total',
+        'Requests handled, by route.', ('route',))
+REQUEST_DURATION = REGISTRY.histogram('tsapp_request_duration_seconds',
+        'Time to handle a request, including sending the body, by route.',
+        ('route',))
+IN_FLIGHT = REGISTRY.gauge('tsapp_requests_in_flight',
+        'Requests being handled.')
+IN_FLIGHT.inc(amount=0)
+RESPONSE_BYTES = REGISTRY.counter('tsapp_response_bytes_total',
+        'Bytes of response body sent, by where they came from.',
+        ('source',))
+UPSTREAM_REQUESTS = REGISTRY.counter('tsapp_upstream_requests_total',
+        'Requests made to the target server, by method and status, '
+        'which is "error" if no response was received.',
+        ('method', 'status'))
+UPSTREAM_DURATION = REGISTRY.histogram('tsapp_upstream_duration_seconds',
+        'Time until the target server responded, by method.', ('method',))
+UPSTREAM_RETRIES = REGISTRY.counter('tsapp_upstream_retries_total',
+        'Requests to the target server sent again after failing, '
+        'by method.', ('method',))
@@ -4,40 +4,72 @@ WSGI app that provides a proxy to tiddlyspace as needed.
 
 from __future__ import absolute_import
 
-import os
 import mimetypes
+import os
 import sys
 import time
 import urllib2
-import uuid
-from re import sub
 
-from .http import http_write
+from .cache import CachedResponse, create_cache
+from .coalesce import create_flights
+from .compress import accepts_gzip, gunzip_chunks
+from .http import http_write, open_request, configure, CHUNK_SIZE
+from .log import create_log_writer, log_time
+from .metrics import (REGISTRY, REQUESTS, REQUEST_DURATION, IN_FLIGHT,
+        RESPONSE_BYTES)
+from .static import AssetIndex, GzipVariants, serve_file
 
 from tsapp import write_config, read_config, delete_config_property
 from tsapp.auth import authenticate
 
 mimetypes.add_type('text/cache-manifest', '.appcache')
 
+# path_info_fixer keeps a / when it follows or precedes these
+KEEP_AFTER = ('users', 'spaces', 'bags', 'recipes', 'tiddlers', 'revisions')
+KEEP_BEFORE = ('tiddlers', 'revisions', 'members')
+
+# Where Metrics answers with the metrics, unless metrics_path is set
+METRICS_PATH = '/_tsapp/metrics'
+
+# Routes, as set in tsapp.route in environ, answered from local files
+LOCAL_ROUTES = ('root', 'assets', 'bag_local')
+
+# Headers from the target server passed on by _send_response
+RESPONSE_HEADERS = ('Content-Type', 'Content-Length', 'Content-Encoding',
+        'Content-Range', 'Accept-Ranges', 'ETag', 'Location', 'Last-Modified',
+        'Cache-Control')
+
 
 def create_app(config):
     """
-    Return the app, configured with proper auth token.
+    Return the app, configured with proper auth token. If warm
+    is set in config the cache is warmed in the background, see
+    tsapp.warm.
     """
-    return Log(App(config))
+    configure(config)
+    app = App(config)
+    if config.get('warm'):
+        from .warm import start_warm
+        start_warm(app, config)
+    return Log(Metrics(app, config), config)
 
 class Log(object):
     """
-    Write a simple log to STDOUT. Based on SimpleLog from TiddlyWeb,
-    which is itself based on Translogger from Paste.
+    Write a simple log to STDOUT, or the sink named by log_sink
+    in config. Based on SimpleLog from TiddlyWeb, which is itself
+    based on Translogger from Paste.
+
+    If log_async is set in config the log is written by a background
+    thread, see tsapp.log.
     """
 
     format = ('%(REMOTE_ADDR)s - %(REMOTE_USER)s [%(time)s] '
             '"%(REQUEST_METHOD)s %(REQUEST_URI)s %(HTTP_VERSION)s" '
             '%(status)s %(bytes)s "%(HTTP_REFERER)s" "%(HTTP_USER_AGENT)s"')
 
-    def __init__(self, application):
+    def __init__(self, application, config=None):
         self.application = application
+        self.writer = create_log_writer(config or {}, self.format_message)
 
     def __call__(self, environ, start_response):
         return self._log_app(environ, start_response)
@@ -64,11 +96,8 @@ class Log(object):
 
     def write_log(self, environ, req_uri, status, size):
         """
-        Print the log info out in a formatted form.
-
-        This is rather more complex than desirable because there is
-        a mix of str and unicode in the gathered data and we need to
-        make it acceptable for output.
+        Gather the log info for this request and hand it
+        to the writer.
         """
         environ['REMOTE_USER'] = '-'
         if size is None:
@@ -79,19 +108,205 @@ class Log(object):
                 'REQUEST_METHOD': environ['REQUEST_METHOD'],
                 'REQUEST_URI': req_uri,
                 'HTTP_VERSION': environ.get('SERVER_PROTOCOL'),
-                'time': time.strftime('%d/%b/%Y:%H:%M:%S ', time.localtime()),
+                'time': time.time(),
                 'status': status.split(None, 1)[0],
                 'bytes': size,
                 'HTTP_REFERER': environ.get('HTTP_REFERER', '-'),
                 'HTTP_USER_AGENT': environ.get('HTTP_USER_AGENT', '-'),
         }
+        self.writer.write(log_format)
+
+    def format_message(self, log_format):
+        """
+        Turn the log info into a formatted message.
+
+        This is rather more complex than desirable because there is
+        a mix of str and unicode in the gathered data and we need to
+        make it acceptable for output.
+        """
+        log_format['time'] = log_time(log_format['time'])
         for key, value in log_format.items():
             try:
                 log_format[key] = value.encode('utf-8', 'replace')
             except UnicodeDecodeError:
                 log_format[key] = value
-        message = self.format % log_format
-        print message
+        return self.format % log_format
+
+
+class Metrics(object):
+    """
+    Count and time requests by the route they took, which handlers
+    record as tsapp.route in environ, and count the bytes sent. A
+    GET of metrics_path in config (METRICS_PATH by default) gets the
+    metrics in tsapp.metrics, with the cache and coalescing counts of
+    application, an App, in the Prometheus text format.
+    """
+
+    def __init__(self, application, config=None):
+        self.application = application
+        self.path = (config or {}).get('metrics_path', METRICS_PATH)
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        IN_FLIGHT.inc()
+        lengths = []
+
+        def replacement_start_response(status, headers, exc_info=None):
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    lengths.append(int(value))
+            return start_response(status, headers, exc_info)
+
+        def done(sent):
+            IN_FLIGHT.dec()
+            route = environ.get('tsapp.route', 'other')
+            REQUESTS.inc((route,))
+            REQUEST_DURATION.observe(time.time() - start, (route,))
+            if sent:
+                if route in LOCAL_ROUTES:
+                    source = 'local'
+                elif route in ('upstream', 'write'):
+                    source = 'upstream'
+                else:
+                    source = 'tsapp'
+                RESPONSE_BYTES.inc((source,), sent)
+
+        try:
+            if (environ.get('PATH_INFO') == self.path
+                    and environ['REQUEST_METHOD'] == 'GET'):
+                environ['tsapp.route'] = 'metrics'
+                body = self.render(replacement_start_response)
+            else:
+                body = self.application(environ, replacement_start_response)
+        except:
+            done(0)
+            raise
+        length = lengths[0] if lengths else None
+        if _is_file_wrapper(body, environ):
+            # pass it through, so the server can still send the file
+            # its own way, and count its length when it is closed
+            return _call_on_close(body, lambda: done(length or 0))
+        return MeteredBody(body, length, done)
+
+    def render(self, start_response):
+        """
+        Respond with the metrics.
+        """
+        extra = []
+        cache = self.application.cache
+        if cache:
+            extra.extend([
+                ('tsapp_cache_hits_total', 'counter',
+                    'Upstream GETs answered from the cache.', cache.hits),
+                ('tsapp_cache_misses_total', 'counter',
+                    'Upstream GETs not in the cache.', cache.misses),
+                ('tsapp_cache_revalidations_total', 'counter',
+                    'Cached responses found unchanged by the target server.',
+                    cache.revalidations),
+                ('tsapp_cache_bytes', 'gauge',
+                    'Bytes of response bodies in the cache.', cache.size),
+            ])
+            second = getattr(cache, 'second', None)
+            if second:
+                extra.extend([
+                    ('tsapp_disk_cache_loads_total', 'counter',
+                        'Responses loaded into memory from the disk cache.',
+                        second.loads),
+                    ('tsapp_disk_cache_bytes', 'gauge',
+                        'Bytes of response bodies in the disk cache, as '
+                        'last known by this process.', second.size),
+                ])
+        flights = self.application.flights
+        if flights:
+            extra.extend([
+                ('tsapp_coalesce_leaders_total', 'counter',
+                    'Upstream GETs made on behalf of coalesced requests.',
+                    flights.leaders),
+                ('tsapp_coalesced_requests_total', 'counter',
+                    'Requests which shared another request\'s upstream GET.',
+                    flights.coalesced),
+                ('tsapp_coalesce_errors_total', 'counter',
+                    'Coalesced upstream GETs which failed.', flights.errors),
+                ('tsapp_coalesce_oversize_total', 'counter',
+                    'Requests which fetched for themselves as the shared '
+                    'response was too large.', flights.oversize),
+                ('tsapp_coalesce_in_flight', 'gauge',
+                    'Coalesced upstream GETs in progress.',
+                    flights.in_flight),
+            ])
+        variants = self.application.variants
+        if variants:
+            extra.append(('tsapp_gzip_cache_bytes', 'gauge',
+                'Bytes of gzip compressed local files kept.', variants.size))
+
+        output = REGISTRY.render(extra)
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(output))),
+            ('Cache-Control', 'no-cache'),
+        ])
+        return [output]
+
+
+class MeteredBody(object):
+    """
+    Iterate over a response body, calling done with the number of
+    bytes sent once it is closed. If length is known the chunks are
+    not counted.
+    """
+
+    def __init__(self, body, length, done):
+        self.body = body
+        self.length = length
+        self.sent = 0
+        self.done = done
+
+    def __iter__(self):
+        if self.length is not None:
+            return iter(self.body)
+        return self._count()
+
+    def _count(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.done(self.length or self.sent)
+
+
+def _is_file_wrapper(body, environ):
+    """
+    True if body was made by the server's wsgi.file_wrapper.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        return False
+    try:
+        return isinstance(body, file_wrapper)
+    except TypeError:
+        return False
+
+
+def _call_on_close(body, callback):
+    """
+    Make closing body call callback after its own close.
+    """
+    close = getattr(body, 'close', None)
+
+    def replacement():
+        try:
+            if close:
+                close()
+        finally:
+            callback()
+
+    body.close = replacement
+    return body
 
 
 class App(object):
@@ -102,15 +317,25 @@ class App(object):
 
     def __init__(self, config):
         self.config = config
+        self.cache = create_cache(config)
+        self.flights = create_flights(config)
+        self.index = AssetIndex(
+                poll_interval=float(config.get('index_poll_interval', 1)))
+        gzip_bytes = int(config.get('gzip_cache_bytes', 32 * 1024 * 1024))
+        self.variants = gzip_bytes and GzipVariants(gzip_bytes,
+                int(config.get('gzip_max_file_bytes', 0))) or None
 
     def __call__(self, environ, start_response):
-        # Always re-read the config as the auth token may be written/removed during a login/logout request.
+        # Always re-read the config as the auth token may be written/removed
+        # during a login/logout request. This is cheap: unchanged files are
+        # not parsed again.
         self.config = read_config()
         method = environ['REQUEST_METHOD'].upper()
         if method != 'GET':
             return handle_write(environ, start_response, method, self.config)
         else:
-            return handle_get(environ, start_response, self.config)
+            return handle_get(environ, start_response, self.config,
+                    self.cache, self.index, self.variants, self.flights)
 
 
 def path_info_fixer(path):
@@ -123,22 +348,28 @@ def path_info_fixer(path):
     path info from.
 
     We can work around this in a known set of URIs, like tiddlyweb's
-    api. Everywhere we expect a /, turn it into a uuid. All
-    the other slashes turn back into %2F, then turn the uuid back
-    into /.
+    api. A / is kept where we expect one: at the start, after one
+    of the collection names in KEEP_AFTER or before one of those
+    in KEEP_BEFORE. All the other slashes turn back into %2F.
 
-    This is probably more complicated than it needs to be but
-    I lost my brain somewhere along the way. I can't believe this
-    sort of stuff still goes on in HTTP servers. Don't mess
-    with the %2F!!!
+    This is done in one pass over the segments of the path. I can't
+    believe this sort of stuff still goes on in HTTP servers. Don't
+    mess with the %2F!!!
     """
-    token = str(uuid.uuid4())
-    path = sub('^/', token, path, count=1)
-    path = sub('(users|spaces|bags|recipes|tiddlers|revisions)/', '\g<1>' + token, path)
-    path = sub('/(tiddlers|revisions|members)', token + '\g<1>', path)
-    path = sub('/', '%2f', path)
-    path = sub(token, '/', path)
-    return path
+    segments = path.split('/')
+    previous = segments[0]
+    output = [previous]
+    for index in xrange(1, len(segments)):
+        segment = segments[index]
+        if ((index == 1 and not previous)
+                or previous.endswith(KEEP_AFTER)
+                or segment.startswith(KEEP_BEFORE)):
+            output.append('/')
+        else:
+            output.append('%2f')
+        output.append(segment)
+        previous = segment
+    return ''.join(output)
 
 
 def handle_write(environ, start_response, method, config):
@@ -153,7 +384,7 @@ def handle_write(environ, start_response, method, config):
     except (KeyError, ValueError):
         content_length = None
         filehandle = None
-    content_type = environ['CONTENT_TYPE']
+    content_type = environ.get('CONTENT_TYPE')
 
     # ensure we don't try to read the input socket on a DELETE
     if method == 'DELETE':
@@ -165,6 +396,7 @@ def handle_write(environ, start_response, method, config):
 
     # Intercept any login attempts and use the authenticate method if no auth token is present
     if path == '/challenge%2ftiddlywebplugins.tiddlyspace.cookie_form':
+        environ['tsapp.route'] = 'auth'
         if auth_token is None:
             form_data = environ['wsgi.input'].read(int(content_length)).split('&')
             user = form_data[0].split('=')[1]
@@ -186,34 +418,39 @@ def handle_write(environ, start_response, method, config):
 
     # Intercept any logout attempts and remove the auth_token
     if path == '/logout':
+        environ['tsapp.route'] = 'auth'
         if auth_token is not None:
             delete_config_property('auth_token')
 
         start_response('204 OK', [('Content-type', 'text/plain')])
         return []
 
+    environ['tsapp.route'] = 'write'
     uri = target_server + path
     if query_string:
         uri = uri + '?' + query_string
     try:
-        response, mime_type = http_write(method=method, uri=uri,
+        response, _ = http_write(method=method, uri=uri,
                 auth_token=auth_token, filehandle=filehandle,
                 count=content_length, mime_type=content_type)
     except IOError, exc:
-        code = exc.getcode()
-        start_response(str(code) + ' error', [])
-        return ['%s' % exc]
+        try:
+            exc.getcode()
+        except AttributeError:
+            raise exc
+        return _send_response(start_response, exc)
 
-    start_response('204 OK', [('Content-type', mime_type)])
-    content = response.read()
-    return content
+    return _send_response(start_response, response)
 
 
-def handle_get(environ, start_response, config):
+def handle_get(environ, start_response, config, cache=None, index=None,
+        variants=None, flights=None):
     """
     Proxy a GET request. Look in the local dir and the assets
-    dir. If not there try at the target server, at the path
-    requested.
+    dir, as listed by index, and serve from there, gzipped by way
+    of variants if there are any. If not there try at the target
+    server, at the path requested, by way of cache if there is one
+    and sharing fetches through flights if given.
     """
     auth_token = config.get('auth_token')
     target_server = config.get('target_server')
@@ -228,71 +465,290 @@ def handle_get(environ, start_response, config):
     control_view = environ.get('HTTP_X_CONTROLVIEW')
     accept = environ.get('HTTP_ACCEPT')
 
-    headers = []
+    if index is None:
+        index = AssetIndex()
 
     try:
-        if len(path_parts) == 1:
-            try:
-                filehandle = open(path)
-                mime_type = mimetypes.guess_type(path)[0]
-            except IOError:
-                filehandle = in_assets(path)
-                mime_type = mimetypes.guess_type(path)[0]
-        elif len(path_parts) == 4 or path_parts[0] == server_prefix:
-            local_path = path_parts[-1]
-            filehandle = in_assets(local_path)
-            mime_type = mimetypes.guess_type(local_path)[0]
-            # Fall back to JSON if we cannot guess
-            if not mime_type:
-                mime_type = 'application/json'
-        else:
-            raise IOError('path wrong length')
-        status = '200 OK'
+        found = find_local(index, path_parts, server_prefix)
+        if not found:
+            raise IOError('not found locally')
+        local_path, _, mime_type = found
+        filehandle = open(local_path, 'rb')
     except IOError:
+        environ['tsapp.route'] = 'upstream'
+        path = path_info_fixer(urllib2.quote(path))
+        if query_string:
+            path = path + '?' + query_string
+        return get_upstream(environ, start_response, target_server, path,
+                accept, auth_token, control_view, cache, flights,
+                server_prefix)
+
+    if len(path_parts) > 1:
+        environ['tsapp.route'] = 'bag_local'
+    elif os.path.dirname(local_path) == index.directories['root']:
+        environ['tsapp.route'] = 'root'
+    else:
+        environ['tsapp.route'] = 'assets'
+    return serve_file(environ, start_response, filehandle, mime_type,
+            variants)
+
+
+def find_local(index, path_parts, server_prefix=None):
+    """
+    The (path, stat, mime_type) of the local file, in index, which
+    answers for the request path split into path_parts, or None.
+    A single name is looked for in the app dir and then in assets,
+    the last part of a /bags/x/tiddlers/name style path in assets.
+    """
+    if len(path_parts) == 1:
+        return index.in_root(path_parts[0]) or index.in_assets(path_parts[0])
+    if len(path_parts) == 4 or path_parts[0] == server_prefix:
+        found = index.in_assets(path_parts[-1])
+        # Fall back to JSON if we cannot guess
+        if found and not found[2]:
+            found = found[:2] + ('application/json',)
+        return found
+    return None
+
+
+def get_upstream(environ, start_response, target_server, path, accept,
+        auth_token, control_view, cache, flights=None, server_prefix=None):
+    """
+    GET path from the target server. If there is a cache, use
+    a fresh entry from it without asking the server, revalidate
+    a stale one with If-None-Match and store new responses that
+    have an ETag. Which happened is reported in an X-Tsapp-Cache
+    header. Entries are kept by target_server and server_prefix as
+    well as the request, as a cache on disk may be shared by apps
+    using different servers.
+
+    If there are flights, a SingleFlight, identical requests made
+    at the same time share one fetch, which is reported as
+    COALESCED. Each request makes its own fetch if the body is too
+    big to share.
+
+    The target server is always asked for gzip. Gzipped content is
+    passed through as is to clients which accept gzip and only
+    decompressed for those which do not.
+
+    A request with a Range is passed on, with any If-Range, and
+    the response passed back as it is, without gzip, the cache or
+    sharing.
+    """
+    byte_range = environ.get('HTTP_RANGE')
+    if byte_range:
+        try:
+            filehandle = at_server(target_server, path, accept, auth_token,
+                    control_view, byte_range=byte_range,
+                    if_range=environ.get('HTTP_IF_RANGE'))
+        except urllib2.HTTPError, exc:
+            filehandle = exc
+        return _send_response(start_response, filehandle)
+
+    gzip_ok = accepts_gzip(environ)
+    key = (target_server, server_prefix, path, accept, control_view,
+            auth_token)
+    entry = None
+    if cache:
+        entry = cache.get(key)
+        if entry and cache.is_fresh(entry):
+            cache.hits += 1
+            return _send_cached(start_response, entry, 'HIT', gzip_ok)
+    etag = entry and entry.etag
+
+    limit = max(flights and flights.max_bytes or 0,
+            cache and cache.max_entry_bytes or 0)
+
+    def fetch():
         try:
-            path = path_info_fixer(urllib2.quote(path))
-            if query_string:
-                path = path + '?' + query_string
             filehandle = at_server(target_server, path, accept,
-                    auth_token, control_view)
-            mime_type = filehandle.info().gettype()
-            # we would prefer text here, not just the code
-            status = '%s ' % filehandle.getcode()
-            if 'etag' in filehandle.info():
-                headers.append(('ETag', filehandle.info()['etag']))
-        except IOError, exc:
-            try:
-                code = exc.getcode()
-            except AttributeError:
-                raise exc
-            start_response(str(code) + ' error', [])
-            return ['%s' % exc]
+                    auth_token, control_view, etag=etag)
+        except urllib2.HTTPError, exc:
+            if exc.getcode() == 304 and etag:
+                exc.close()
+                return None, None
+            # an error response is passed on like any other
+            filehandle = exc
+        return _read_upstream(filehandle, limit)
+
+    shared = False
+    if flights:
+        # the etag is part of the key, so that a 304 is
+        # only shared with those holding the same entry
+        (response, partial), shared = flights.do(key + (etag,), fetch)
+        if shared and partial:
+            flights.oversize += 1
+            response, partial = fetch()
+    else:
+        response, partial = fetch()
+
+    if not response and not partial:
+        cache.refresh(key, entry)
+        cache.revalidations += 1
+        return _send_cached(start_response, entry, 'REVALIDATED', gzip_ok)
+
+    if response:
+        if shared:
+            outcome = 'COALESCED'
+        elif cache:
+            cache.misses += 1
+            outcome = 'MISS'
+            if response.etag and response.status.startswith('200'):
+                cache.put(key, response)
+        else:
+            outcome = None
+        return _send_cached(start_response, response, outcome, gzip_ok)
+
+    filehandle, data = partial
+    outcome = None
+    if cache:
+        cache.misses += 1
+        outcome = 'MISS'
+    return _stream_upstream(start_response, filehandle, data, gzip_ok,
+            outcome)
+
 
-    headers.append(('Content-Type', mime_type))
+def _read_upstream(filehandle, limit):
+    """
+    Read the response filehandle if its body is no more than
+    limit bytes. Return (CachedResponse, None) if it was, or
+    (None, (filehandle, data)) with what was read if not.
+    """
+    data = ''
+    if limit:
+        data = filehandle.read(limit + 1)
+        if len(data) <= limit:
+            filehandle.close()
+            info = filehandle.info()
+            return CachedResponse(status_line(filehandle),
+                    info.gettype(), info.get('etag'), data,
+                    info.get('content-encoding'), info.get('vary')), None
+    return None, (filehandle, data)
+
+
+def status_line(response):
+    """
+    The WSGI status for a response, or HTTPError, from the
+    target server.
+    """
+    return '%s %s' % (response.getcode(), response.msg or '')
+
+
+def _send_response(start_response, response):
+    """
+    Respond with the status, some headers and the body of a
+    response, or HTTPError, from the target server, streaming
+    the body. A response without a body is closed at once.
+    """
+    info = response.info()
+    headers = [(name, info[name.lower()]) for name in RESPONSE_HEADERS
+            if info.get(name.lower())]
+    start_response(status_line(response), headers)
+    if response.getcode() in (204, 304) or info.get('content-length') == '0':
+        response.close()
+        return []
+    return _prepend('', response)
+
+
+def _stream_upstream(start_response, filehandle, data, gzip_ok,
+        outcome=None):
+    """
+    Respond with the response, or HTTPError, filehandle from the
+    target server, of which data has already been read, streaming
+    the rest.
+    """
+    info = filehandle.info()
+    return _send_upstream(start_response, status_line(filehandle),
+            info.gettype(), info.get('etag'), info.get('content-encoding'),
+            info.get('vary'), info.get('content-length'),
+            _prepend(data, filehandle), gzip_ok, outcome)
+
+
+def _send_cached(start_response, entry, outcome, gzip_ok):
+    """
+    Respond with a CachedResponse.
+    """
+    return _send_upstream(start_response, entry.status, entry.mime_type,
+            entry.etag, entry.encoding, entry.vary, str(len(entry.body)),
+            [entry.body], gzip_ok, outcome)
+
+
+def _send_upstream(start_response, status, mime_type, etag, encoding, vary,
+        length, body, gzip_ok, outcome=None):
+    """
+    Respond with content from the target server, decompressing
+    gzipped content if the client does not accept gzip.
+    """
+    if encoding == 'gzip':
+        if not vary:
+            vary = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            vary = '%s, Accept-Encoding' % vary
+        if not gzip_ok:
+            encoding = None
+            # the decompressed content is not byte for byte
+            # what the ETag describes
+            if etag and not etag.startswith('W/'):
+                etag = 'W/' + etag
+            if isinstance(body, list):
+                body = [''.join(gunzip_chunks(body))]
+                length = str(len(body[0]))
+            else:
+                body = gunzip_chunks(body)
+                length = None
+
+    headers = [('Content-Type', mime_type)]
+    if etag:
+        headers.append(('ETag', etag))
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    if vary:
+        headers.append(('Vary', vary))
+    if length is not None:
+        headers.append(('Content-Length', length))
+    if outcome:
+        headers.append(('X-Tsapp-Cache', outcome))
     start_response(status, headers)
-    return filehandle
+    return body
 
 
-def in_assets(path):
+def _prepend(data, filehandle):
     """
-    Open the requested path in the assets directory.
-    If the file is not present, an error will cause
-    a failover to the target server.
+    Yield data and then the rest of filehandle, closing it
+    at the end.
     """
-    return open(os.path.join('.', 'assets', path))
+    try:
+        if data:
+            yield data
+        for chunk in iter(lambda: filehandle.read(CHUNK_SIZE), ''):
+            yield chunk
+    finally:
+        filehandle.close()
 
 
-def at_server(server, path, accept, auth_token, control_view):
+def at_server(server, path, accept, auth_token, control_view, etag=None,
+        byte_range=None, if_range=None):
     """
-    Filehandle for the resource at the target server.
+    Filehandle for the resource at the target server. If etag
+    is given the request is made conditional on it. If byte_range
+    is given only that Range, subject to if_range, is asked for,
+    and not gzipped, as ranges are of the content as it is.
     """
     if not path.startswith('/'):
         path = '/%s' % path
     req = urllib2.Request(server + path)
+    if byte_range:
+        req.add_header('Range', byte_range)
+        if if_range:
+            req.add_header('If-Range', if_range)
+    else:
+        req.add_header('Accept-Encoding', 'gzip')
     if accept:
         req.add_header('Accept', accept)
     if auth_token:
         req.add_header('Cookie', 'tiddlyweb_user=%s' % auth_token)
     if control_view:
         req.add_header('X-ControlView', 'false')
-    return urllib2.urlopen(req)
+    if etag:
+        req.add_header('If-None-Match', etag)
+    return open_request(req, redirect=True)
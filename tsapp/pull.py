@@ -0,0 +1,204 @@
+"""
+Pull the tiddlers in a bag on the target server into assets.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from .compress import gunzip_chunks
+from .http import open_request, CHUNK_SIZE
+from .manifest import load_manifest, save_manifest
+from .push import find_sources, target_uri
+from .workers import run_jobs
+
+
+# Tiddlers of these types (or none) are saved as JSON, others
+# are saved as their raw content.
+WIKITEXT_TYPES = (None, '', 'None', 'text/x-tiddlywiki')
+
+
+def pull_bag(server, bag, auth_token, server_prefix=None, workers=4,
+        force=False):
+    """
+    Download every tiddler in bag at server into assets, so serve
+    can answer for them locally. Tiddlers with a non-wikitext type
+    are saved as their raw content, the rest as JSON, each under its
+    title.
+
+    The ETag of each tiddler pulled is kept in the manifest and
+    sent as If-None-Match next time, so unchanged tiddlers are not
+    downloaded again unless force is True. Up to workers tiddlers
+    are downloaded at once. An IOError is raised at the end if any
+    failed.
+
+    Local work is not overwritten: a tiddler which another local
+    file, such as index.html for index, is pushed to is skipped, as
+    is one whose file in assets was not pulled, or has changed since
+    it was, unless force is True.
+    """
+    start = time.time()
+    collection = target_uri(server, bag, '', server_prefix)
+    tiddlers = list_tiddlers(collection.rstrip('/'), auth_token)
+
+    # what each local file is pushed to, pulled files aside
+    pushed_from = dict((target_uri(server, bag, path, server_prefix), path)
+            for path in find_sources())
+
+    manifest = load_manifest()
+    section = manifest.setdefault('pull %s' % collection, {})
+    if not os.path.isdir('assets'):
+        os.mkdir('assets')
+
+    progress = {'done': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def report(title, outcome, size=0, reason=None):
+        lock.acquire()
+        try:
+            progress['done'] += 1
+            progress['bytes'] += size
+            sys.stdout.write('[%s/%s] %s %s%s\n' % (progress['done'],
+                len(tiddlers), outcome, title.encode('utf-8'),
+                reason and ' (%s)' % reason or ''))
+        finally:
+            lock.release()
+
+    def pull_one(tiddler):
+        title = tiddler['title']
+        if '/' in title or os.sep in title or title in ('.', '..'):
+            report(title, 'skipped', reason='not a file name')
+            return 'skipped', None
+        path = os.path.join('assets', title)
+        uri = collection + urllib2.quote(title.encode('utf-8'), safe='')
+        source = pushed_from.get(uri)
+        if source and source != 'assets/%s' % title.encode('utf-8'):
+            report(title, 'skipped', reason='pushed from %s' % source)
+            return 'skipped', None
+        known = section.get(title)
+        if os.path.exists(path) and not force:
+            if not known:
+                report(title, 'skipped', reason='local file not pulled, '
+                        'use --force to replace it')
+                return 'skipped', None
+            if _changed(path, known):
+                report(title, 'skipped', reason='changed locally, '
+                        'use --force to replace it')
+                return 'skipped', None
+        if force or not os.path.exists(path):
+            known = None
+        try:
+            etag, size = _pull_tiddler(uri, path, tiddler.get('type'),
+                auth_token, known and known.get('etag'))
+        except Exception:
+            report(title, 'failed')
+            raise
+        if etag is None:
+            report(title, 'unchanged')
+            return 'unchanged', None
+        report(title, 'pulled', size)
+        return 'pulled', {'etag': etag, 'size': size,
+                'mtime': os.stat(path).st_mtime}
+
+    counts = {'pulled': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+    for tiddler, result, exc in run_jobs(pull_one, tiddlers, workers):
+        if exc:
+            counts['failed'] += 1
+            sys.stderr.write('Failed to pull %s: %s\n'
+                    % (tiddler['title'].encode('utf-8'), exc))
+            continue
+        outcome, state = result
+        counts[outcome] += 1
+        if state:
+            section[tiddler['title']] = state
+
+    save_manifest(manifest)
+
+    counts['time'] = time.time() - start
+    counts['rate'] = progress['bytes'] / 1024.0 / (counts['time'] or 1)
+    print ('Pulled %(pulled)s, unchanged %(unchanged)s, skipped %(skipped)s, '
+            'failed %(failed)s in %(time).2fs (%(rate).1f KB/s)' % counts)
+
+    if counts['failed']:
+        raise IOError('%s of %s tiddlers failed to pull'
+                % (counts['failed'], len(tiddlers)))
+
+
+def _changed(path, known):
+    """
+    True if the file at path is not as it was when pulled,
+    according to known, its manifest entry.
+    """
+    stat = os.stat(path)
+    if stat.st_size != known.get('size'):
+        return True
+    return 'mtime' in known and stat.st_mtime != known['mtime']
+
+
+def list_tiddlers(uri, auth_token):
+    """
+    The list of tiddler dicts in the collection at uri.
+    """
+    req = urllib2.Request(uri.encode('utf-8'))
+    req.add_header('Accept', 'application/json')
+    if auth_token:
+        req.add_header('Cookie', 'tiddlyweb_user=%s' % auth_token)
+    response = open_request(req, redirect=True)
+    try:
+        return json.loads(response.read())
+    finally:
+        response.close()
+
+
+def _pull_tiddler(uri, path, tiddler_type, auth_token, etag):
+    """
+    Download the tiddler at uri to path, by way of a temporary
+    file. Return its ETag and size, or (None, 0) if it has not
+    changed since etag.
+    """
+    req = urllib2.Request(uri)
+    req.add_header('Accept-Encoding', 'gzip')
+    if tiddler_type in WIKITEXT_TYPES:
+        req.add_header('Accept', 'application/json')
+    else:
+        req.add_header('Accept', tiddler_type)
+    if auth_token:
+        req.add_header('Cookie', 'tiddlyweb_user=%s' % auth_token)
+    if etag:
+        req.add_header('If-None-Match', etag)
+
+    try:
+        response = open_request(req, redirect=True)
+    except urllib2.HTTPError, exc:
+        if exc.getcode() == 304:
+            return None, 0
+        raise
+
+    chunks = iter(lambda: response.read(CHUNK_SIZE), '')
+    if response.info().get('content-encoding') == 'gzip':
+        chunks = gunzip_chunks(chunks)
+
+    handle, temp_path = tempfile.mkstemp(prefix='.pull', dir='assets')
+    size = 0
+    try:
+        temp_file = os.fdopen(handle, 'wb')
+        try:
+            for chunk in chunks:
+                temp_file.write(chunk)
+                size += len(chunk)
+        finally:
+            temp_file.close()
+            response.close()
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+    return response.info().get('etag') or '', size
@@ -5,46 +5,207 @@ Push assets to the target server.
 from __future__ import absolute_import
 
 import glob
+import mimetypes
+import sys
+import tempfile
+import time
 import urllib2
 
-from .http import http_write
+from .compress import gzip_chunks, is_compressible
+from .http import http_write, CHUNK_SIZE
+from .manifest import load_manifest, save_manifest, file_state
+from .workers import run_jobs
 
 
-def push_assets(server, bag, auth_token, tiddler=None, hard=False, server_prefix=None):
+def push_assets(server, bag, auth_token, tiddler=None, hard=False,
+        server_prefix=None, workers=1, force=False, gzip=False, paths=None):
     """
-    Push *.html in the local dir and everything in assets
-    to server, into the named bag, using the provided
-    auth_token (if any). If hard is True, delete the assets first.
+    Push *.html in the local dir and everything in assets, or
+    just the files in paths if given, to server, into the named bag,
+    using the provided auth_token (if any). If hard is True, delete
+    the assets first. If gzip is True, compressible files are sent
+    gzip encoded.
+
+    Files whose content has not changed since they were last
+    pushed to this server and bag, according to the manifest,
+    are not pushed again unless force or hard is True.
+
+    Up to workers files are pushed at the same time. A failure
+    to push one file does not stop the others: errors are reported
+    per file and the paths which failed are returned.
+    """
+    start = time.time()
+    if paths is None:
+        paths = find_sources(tiddler)
+    jobs = [(path, target_uri(server, bag, path, server_prefix))
+            for path in paths]
+
+    manifest = load_manifest()
+    section = manifest.setdefault(
+            target_uri(server, bag, '', server_prefix), {})
+    force = force or hard
+
+    def push_one(job):
+        path, uri = job
+        known = section.get(path)
+        state = file_state(path, known)
+        if not force and known and known.get('hash') == state['hash']:
+            return 'unchanged', state
+        if _push_file(path, uri, auth_token, hard, gzip):
+            return 'pushed', state
+        return 'skipped', None
+
+    counts = {'pushed': 0, 'unchanged': 0, 'skipped': 0}
+    failed = []
+    for job, result, exc in run_jobs(push_one, jobs, workers):
+        if exc:
+            failed.append(job[0])
+            sys.stderr.write('Failed to push %s: %s\n' % (job[0], exc))
+            continue
+        outcome, state = result
+        counts[outcome] += 1
+        if state:
+            section[job[0]] = state
+
+    save_manifest(manifest)
+
+    counts['failed'] = len(failed)
+    counts['time'] = time.time() - start
+    print ('Pushed %(pushed)s, unchanged %(unchanged)s, skipped %(skipped)s, '
+            'failed %(failed)s in %(time).2fs' % counts)
+    return failed
+
+
+def delete_assets(server, bag, auth_token, paths, server_prefix=None,
+        workers=1):
+    """
+    Delete the tiddlers in bag on server which the local files in
+    paths, no longer there, were pushed to, and forget them in the
+    manifest. A tiddler still pushed from another local file, as
+    index.html and assets/index both are, is kept. Tiddlers already
+    gone are not an error. The paths whose tiddlers could not be
+    deleted are returned, and stay in the manifest.
+    """
+    remaining = set(target_uri(server, bag, path, server_prefix)
+            for path in find_sources())
+    jobs = []
+    for path in paths:
+        uri = target_uri(server, bag, path, server_prefix)
+        if uri not in remaining:
+            jobs.append((path, uri))
+
+    def delete_one(job):
+        try:
+            response, _ = http_write(method='DELETE', uri=job[1],
+                    auth_token=auth_token)
+            response.read()
+            response.close()
+        except urllib2.HTTPError, exc:
+            if exc.getcode() != 404:
+                raise
+
+    manifest = load_manifest()
+    section = manifest.setdefault(
+            target_uri(server, bag, '', server_prefix), {})
+    failed = []
+    for job, _, exc in run_jobs(delete_one, jobs, workers):
+        if exc:
+            failed.append(job[0])
+            sys.stderr.write('Failed to delete %s: %s\n' % (job[1], exc))
+        else:
+            print 'Deleted %s' % job[1]
+    for path in paths:
+        if path not in failed:
+            section.pop(path, None)
+    save_manifest(manifest)
+    return failed
+
+
+def find_sources(tiddler=None):
+    """
+    List the local files to be pushed: the named tiddler, if
+    provided, otherwise *.html and everything in assets.
     """
     if tiddler:
-        sources = glob.glob('assets/%s' % tiddler) + glob.glob(tiddler)
-    else:
-        sources = glob.glob('*.html') + glob.glob('assets/*')
-
-    for path in sources:
-        target_name = path
-        if target_name.endswith('.html') or target_name.endswith('.tid'):
-            target_name = target_name.rsplit('.', 1)[0]
-        if '/' in target_name:
-            target_name = target_name.split('/')[-1]
-        target_path = '/bags/%s/tiddlers/%s' % (urllib2.quote(bag),
-                urllib2.quote(target_name))
-        if server_prefix:
-            target_path = '/%s%s' % (server_prefix, target_path)
-
-        uri = server + target_path
-
-        if hard:
-            # delete the tiddler, but if it is not there, don't
-            # worry
-            try:
-                http_write(method='DELETE', uri=uri, auth_token=auth_token,
-                        filename=path)
-            except urllib2.HTTPError, exc:
-                status = exc.getcode()
-                if status == 404:
-                    pass
-                else:
-                    raise
-        http_write(method='PUT', uri=uri, auth_token=auth_token,
-                filename=path)
+        return glob.glob('assets/%s' % tiddler) + glob.glob(tiddler)
+    return glob.glob('*.html') + glob.glob('assets/*')
+
+
+def target_uri(server, bag, path, server_prefix=None):
+    """
+    Map a local file path to the URI of its tiddler in bag.
+    """
+    target_name = path
+    if target_name.endswith('.html') or target_name.endswith('.tid'):
+        target_name = target_name.rsplit('.', 1)[0]
+    if '/' in target_name:
+        target_name = target_name.split('/')[-1]
+    target_path = '/bags/%s/tiddlers/%s' % (urllib2.quote(bag),
+            urllib2.quote(target_name))
+    if server_prefix:
+        target_path = '/%s%s' % (server_prefix, target_path)
+
+    return server + target_path
+
+
+def _push_file(path, uri, auth_token, hard, gzip=False):
+    """
+    PUT one file to uri, first deleting it if hard is True.
+    Return False if the file was skipped.
+
+    If gzip is True and the file is compressible it is sent with
+    Content-Encoding: gzip, unless the server answers that with
+    415 Unsupported Media Type, in which case it is sent as is.
+    """
+    if hard:
+        # delete the tiddler, but if it is not there, don't
+        # worry
+        try:
+            http_write(method='DELETE', uri=uri, auth_token=auth_token,
+                    filename=path)
+        except urllib2.HTTPError, exc:
+            status = exc.getcode()
+            if status == 404:
+                pass
+            else:
+                raise
+
+    response = None
+    mime_type = mimetypes.guess_type(path, strict=False)[0]
+    if gzip and is_compressible(mime_type):
+        try:
+            response = _put_gzipped(path, uri, auth_token, mime_type)
+        except urllib2.HTTPError, exc:
+            if exc.getcode() != 415:
+                raise
+
+    if response is None:
+        response, mime_type = http_write(method='PUT', uri=uri,
+                auth_token=auth_token, filename=path)
+    if response is None:
+        return False
+    # finish the response so its connection can be reused
+    response.read()
+    response.close()
+    return True
+
+
+def _put_gzipped(path, uri, auth_token, mime_type):
+    """
+    PUT the file at path gzip encoded, compressing it to a
+    temporary file first so its length is known.
+    """
+    source = open(path, 'rb')
+    compressed = tempfile.TemporaryFile()
+    try:
+        chunks = iter(lambda: source.read(CHUNK_SIZE), '')
+        for chunk in gzip_chunks(chunks):
+            compressed.write(chunk)
+        compressed.seek(0)
+        response, _ = http_write(method='PUT', uri=uri,
+                auth_token=auth_token, filehandle=compressed,
+                mime_type=mime_type, content_encoding='gzip')
+    finally:
+        source.close()
+        compressed.close()
+    return response
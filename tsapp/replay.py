@@ -0,0 +1,138 @@
+"""
+Replay the GET and HEAD requests in an access log, as written by
+the proxy's Log middleware or any server using the combined log
+format, against `tsapp serve`, keeping to the timing of the
+original traffic.
+
+The load is made and measured with the same clients as bench.
+"""
+
+from __future__ import absolute_import
+
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from .bench import (FakeUpstream, make_fixture, start_serve, free_port,
+        run_load, summarize)
+
+
+LOG_LINE = re.compile(r'^\S+ \S+ .*? \[([^\]]+)\] "(\S+) (\S+)[^"]*" '
+        r'(\d{3}|-) ')
+
+LOG_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+REPLAY_METHODS = ('GET', 'HEAD')
+
+
+def parse_log(lines):
+    """
+    The (time, method, path) of each GET or HEAD request in lines,
+    in order, and the number of lines that were something else.
+    """
+    requests = []
+    skipped = 0
+    for line in lines:
+        match = LOG_LINE.match(line)
+        if not match:
+            skipped += 1
+            continue
+        stamp, method, path, _ = match.groups()
+        if method not in REPLAY_METHODS:
+            skipped += 1
+            continue
+        try:
+            # any time zone is ignored, only intervals matter
+            when = time.mktime(time.strptime(stamp.split()[0],
+                LOG_TIME_FORMAT))
+        except ValueError:
+            skipped += 1
+            continue
+        requests.append((when, method, path))
+    return requests, skipped
+
+
+def replay_requests(requests, speed=1, accept='*/*'):
+    """
+    Return a next_request function for run_load making requests,
+    as from parse_log. Each is held back until its time in the log,
+    relative to the first, divided by speed, has passed since the
+    first was made. A speed of 0 makes them as fast as possible.
+    The start time and how far behind the log the requests got are
+    kept on the function, as started and lag.
+    """
+    first = requests and requests[0][0]
+    lock = threading.Lock()
+
+    def next_request(number):
+        if number >= len(requests):
+            return None
+        when, method, path = requests[number]
+        lock.acquire()
+        try:
+            if next_request.started is None:
+                next_request.started = time.time()
+        finally:
+            lock.release()
+        if speed:
+            due = next_request.started + (when - first) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_request.lag = max(next_request.lag, -delay)
+        return method, path, None, {'Accept': accept}
+
+    next_request.started = None
+    next_request.lag = 0
+    return next_request
+
+
+def run_replay(requests, host='127.0.0.1', port=8080, speed=1,
+        concurrency=10, duration=None, accept='*/*'):
+    """
+    Replay requests against serve at host:port and return a
+    summary, with the greatest lag behind the log in seconds.
+    """
+    next_request = replay_requests(requests, speed, accept)
+    result = run_load(host, port, next_request, concurrency=concurrency,
+            duration=duration)
+    summary = summarize('replay', result)
+    summary['max_lag'] = round(next_request.lag, 3)
+    return summary
+
+
+def run_fake_replay(requests, latency=0, payload_size=1024, **settings):
+    """
+    Replay requests against a freshly started serve, proxying
+    to a local stand in for the target server as in bench.
+    """
+    upstream = FakeUpstream(latency=latency, payload_size=payload_size)
+    upstream.start()
+    directory = tempfile.mkdtemp(prefix='tsapp-replay')
+    port = free_port()
+    process = None
+    try:
+        make_fixture(directory, upstream.uri, port, payload_size)
+        process = start_serve(directory, port)
+        return run_replay(requests, port=port, **settings)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        upstream.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def print_breakdown(summary):
+    """
+    Print the statuses and errors of a replay, and how far
+    behind the log it fell.
+    """
+    for status, number in sorted(summary['statuses'].items()):
+        print '  status %-16s %8d' % (status, number)
+    for error, number in sorted(summary['error_types'].items()):
+        print '  failed, %-15s %8d' % (error, number)
+    print '  max lag behind log %6.3fs' % summary['max_lag']
@@ -1,24 +1,232 @@
 """
 Start a web server to host the proxy.
+
+With server_processes set above 1 in config, that many worker
+processes are forked, each running its own server. They share the
+port by each binding it with SO_REUSEPORT, so the kernel spreads
+connections between them, or where that is not available by all
+accepting on one socket made before forking.
 """
 
+import atexit
+import errno
+import os
+import signal
+import socket
 import sys
+import time
 
 from .proxy import create_app
 from cherrypy.wsgiserver import CherryPyWSGIServer
 
 
+# Python 2 does not know the value, which is 15 on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+        sys.platform.startswith('linux') and 15 or None)
+
+# A worker which exits sooner than this after starting is
+# not started again until this long has passed.
+RESPAWN_DELAY = 1
+
+
+class Server(CherryPyWSGIServer):
+    """
+    A CherryPyWSGIServer which either binds its socket with
+    SO_REUSEPORT, when reuse_port is True, or accepts on listener,
+    an already bound socket, if given.
+    """
+
+    reuse_port = False
+    listener = None
+
+    def bind(self, family, type, proto=0):
+        if self.listener is not None:
+            self.socket = self.listener
+            return
+        if not self.reuse_port:
+            return CherryPyWSGIServer.bind(self, family, type, proto)
+        self.socket = socket.socket(family, type, proto)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.nodelay:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.bind(self.bind_addr)
+
+
 def start_server(config):
     """
-    Make a server and start it up as a daemon.
+    Make a server, or server_processes of them, and start it up
+    as a daemon. A SIGTERM stops the server gracefully.
+    """
+    processes = int(config.get('server_processes', 1))
+    if processes > 1:
+        if not hasattr(os, 'fork'):
+            from tsapp import error_exit
+            error_exit(1, 'server_processes requires os.fork')
+        Supervisor(config, processes).run()
+    else:
+        run_server(config)
+
+
+def make_server(config):
+    """
+    A Server for the proxy, with its thread pool and queues
+    sized by config.
     """
     port = int(config['port'])
     local_host = config['local_host']
+    return Server((local_host, port), create_app(config),
+            numthreads=int(config.get('server_threads', 10)),
+            request_queue_size=int(config.get('server_backlog', 5)),
+            accepted_queue_size=int(config.get('server_request_queue_size',
+                -1)))
 
-    server = CherryPyWSGIServer((local_host, port), create_app(config))
+
+def run_server(config, reuse_port=False, listener=None):
+    """
+    Run a server until interrupted or sent SIGTERM.
+    """
+    server = make_server(config)
+    server.reuse_port = reuse_port
+    server.listener = listener
+    signal.signal(signal.SIGTERM, _exit)
 
     try:
         server.start()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
         server.stop()
         sys.exit(0)
+
+
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
+class Supervisor(object):
+    """
+    Fork processes workers, each running a server, and start a new
+    one when one exits. On SIGTERM or SIGINT the workers are sent
+    SIGTERM, and given shutdown_timeout seconds to finish the requests
+    they are handling before they are killed.
+    """
+
+    def __init__(self, config, processes, shutdown_timeout=10):
+        self.config = config
+        self.processes = processes
+        self.shutdown_timeout = shutdown_timeout
+        self.workers = {}
+        self.stopping = False
+        self.reuse_port = False
+        self.listener = None
+
+    def run(self):
+        address = (self.config['local_host'], int(self.config['port']))
+        self.reuse_port = _reuse_port_works(address)
+        if not self.reuse_port:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET,
+                    socket.SO_REUSEADDR, 1)
+            self.listener.bind(address)
+            self.listener.listen(int(self.config.get('server_backlog', 5)))
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        sharing = (self.reuse_port and 'with SO_REUSEPORT'
+                or 'through one socket')
+        print 'Starting %s worker processes sharing the port %s' % (
+                self.processes, sharing)
+        sys.stdout.flush()
+        for _ in range(self.processes):
+            self.spawn()
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            sys.stderr.write('worker %s exited with status %s, restarting\n'
+                    % (pid, status))
+            if time.time() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            if not self.stopping:
+                self.spawn()
+
+    def spawn(self):
+        """
+        Fork a worker which runs a server until sent SIGTERM.
+        """
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, _exit)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            run_server(self.config, self.reuse_port, self.listener)
+        except SystemExit, exc:
+            status = exc.code or 0
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            # skip the parent's stack, but let the log be written
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        """
+        Stop the workers, gracefully at first.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        for pid in self.workers:
+            _kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.shutdown_timeout
+        while self.workers and time.time() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.workers.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in self.workers:
+            _kill(pid, signal.SIGKILL)
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass
+
+
+def _reuse_port_works(address):
+    """
+    True if two sockets can be bound to address with SO_REUSEPORT.
+    """
+    if SO_REUSEPORT is None:
+        return False
+    sockets = []
+    try:
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind(address)
+        return True
+    except socket.error:
+        return False
+    finally:
+        for sock in sockets:
+            sock.close()
@@ -0,0 +1,428 @@
+"""
+Serve files from the local app dir and assets.
+"""
+
+import email.utils
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from stat import S_ISREG
+
+from .compress import (accepts_gzip, gzip_chunks, is_compressible,
+        MIN_COMPRESS_SIZE)
+from .http import CHUNK_SIZE
+
+
+# A Range header asking for more ranges than this is ignored.
+MAX_RANGES = 16
+
+
+class AssetIndex(object):
+    """
+    The regular files in the app dir and in its assets dir, by name,
+    with their path, stat data and guessed mime type. Routing a GET
+    is then a dict lookup, and a name that is not there can go
+    straight to the target server.
+
+    The index is kept current by polling: at most once every
+    poll_interval seconds the two dirs are stat'ed, and one whose
+    mtime has changed (or changed very recently, as mtimes can be
+    coarse) is scanned again.
+    """
+
+    def __init__(self, root='.', poll_interval=1):
+        self.poll_interval = poll_interval
+        self.directories = {
+            'root': root,
+            'assets': os.path.join(root, 'assets'),
+        }
+        self._files = {'root': {}, 'assets': {}}
+        self._stamps = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def in_root(self, name):
+        """
+        The (path, stat, mime_type) of name in the app dir, or None.
+        """
+        self.refresh()
+        return self._files['root'].get(name)
+
+    def in_assets(self, name):
+        """
+        The (path, stat, mime_type) of name in assets, or None.
+        """
+        self.refresh()
+        return self._files['assets'].get(name)
+
+    def refresh(self, force=False):
+        """
+        Scan again any dir which has changed, if it is time to check.
+        """
+        now = time.time()
+        if not force and now - self._checked < self.poll_interval:
+            return
+        # if another thread is already checking, use what we have
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._checked = now
+            for key, directory in self.directories.items():
+                try:
+                    stat = os.stat(directory)
+                    stamp = (stat.st_mtime, stat.st_ino)
+                except OSError:
+                    stamp = None
+                if force or stamp is None or stamp != self._stamps.get(key):
+                    self._files[key] = self._scan(directory)
+                    if stamp and now - stamp[0] < 2:
+                        stamp = 'recent'
+                    self._stamps[key] = stamp
+        finally:
+            self._lock.release()
+
+    def _scan(self, directory):
+        files = {}
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return files
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if S_ISREG(stat.st_mode):
+                files[name] = (path, stat, mimetypes.guess_type(name)[0])
+        return files
+
+
+class GzipVariants(object):
+    """
+    gzip compressed copies of local files, kept in memory by the
+    SHA1 of their content, so identical files share one copy.
+
+    Each path remembers the mtime and size it had when compressed.
+    When they change the file is hashed, and compressed if its new
+    content has not been seen, again. The least recently used copies
+    are dropped to keep the total under max_bytes.
+
+    Files are streamed through the hash and the compressor, so only
+    the compressed copy is held in memory. Files larger than
+    max_file_bytes, by default a tenth of max_bytes, are not
+    compressed at all.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes or max_bytes // 10
+        self.size = 0
+        self._paths = {}
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filehandle, stat):
+        """
+        The gzip variant of the open file filehandle, whose
+        fstat is stat.
+        """
+        signature = (stat.st_mtime, stat.st_size)
+        known = self._paths.get(filehandle.name)
+        if known and known[0] == signature:
+            variant = self._lookup(known[1])
+            if variant is not None:
+                return variant
+
+        digest = hashlib.sha1()
+        for chunk in FileIterator(filehandle):
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        self._paths[filehandle.name] = (signature, digest)
+
+        variant = self._lookup(digest)
+        if variant is None:
+            filehandle.seek(0)
+            variant = ''.join(gzip_chunks(FileIterator(filehandle)))
+            self._store(digest, variant)
+        return variant
+
+    def accepts(self, stat):
+        """
+        True if the file whose fstat is stat is small enough to
+        have a variant.
+        """
+        return MIN_COMPRESS_SIZE <= stat.st_size <= self.max_file_bytes
+
+    def _lookup(self, digest):
+        self._lock.acquire()
+        try:
+            variant = self._variants.pop(digest, None)
+            if variant is not None:
+                self._variants[digest] = variant
+            return variant
+        finally:
+            self._lock.release()
+
+    def _store(self, digest, variant):
+        self._lock.acquire()
+        try:
+            if digest not in self._variants:
+                self._variants[digest] = variant
+                self.size += len(variant)
+            while self.size > self.max_bytes and self._variants:
+                _, evicted = self._variants.popitem(last=False)
+                self.size -= len(evicted)
+        finally:
+            self._lock.release()
+
+
+class FileIterator(object):
+    """
+    Iterate over an open file in chunks of chunk_size, for
+    servers which do not provide wsgi.file_wrapper.
+    """
+
+    def __init__(self, filehandle, chunk_size=CHUNK_SIZE):
+        self.filehandle = filehandle
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            chunk = self.filehandle.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.filehandle.close()
+
+
+def serve_file(environ, start_response, filehandle, mime_type,
+        variants=None):
+    """
+    Respond with the content of the open file filehandle, with
+    validators derived from its stat data. A conditional request
+    which matches them gets a 304.
+
+    If variants, a GzipVariants, is given and the file is
+    compressible and not too big for it, a client accepting gzip
+    gets the gzip variant, unless it asks for a Range. Ranges are
+    of the file as it is, and get a 206 or, if none can be
+    satisfied, a 416.
+
+    The browser is asked to revalidate every time, so edits to
+    local files show up on reload.
+    """
+    stat = os.fstat(filehandle.fileno())
+    etag = file_etag(stat)
+    byte_range = environ.get('HTTP_RANGE')
+    headers = [
+        ('Last-Modified', email.utils.formatdate(stat.st_mtime,
+            usegmt=True)),
+        ('Cache-Control', 'no-cache'),
+    ]
+
+    body = None
+    if variants and is_compressible(mime_type) and variants.accepts(stat):
+        headers.append(('Vary', 'Accept-Encoding'))
+        if accepts_gzip(environ) and not byte_range:
+            etag = etag[:-1] + '-gz"'
+            headers.append(('Content-Encoding', 'gzip'))
+            if not not_modified(environ, etag, stat.st_mtime):
+                body = variants.get(filehandle, stat)
+    headers.append(('ETag', etag))
+
+    if not_modified(environ, etag, stat.st_mtime):
+        filehandle.close()
+        start_response('304 Not Modified', headers)
+        return []
+
+    mime_type = mime_type or 'application/octet-stream'
+
+    if body is not None:
+        filehandle.close()
+        headers.append(('Content-Type', mime_type))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+    headers.append(('Accept-Ranges', 'bytes'))
+    if byte_range and if_range_matches(environ, etag, stat.st_mtime):
+        ranges = parse_ranges(byte_range, stat.st_size)
+        if ranges is not None:
+            return serve_ranges(start_response, filehandle, mime_type,
+                    headers, ranges, stat.st_size)
+
+    headers.append(('Content-Type', mime_type))
+    headers.append(('Content-Length', str(stat.st_size)))
+    start_response('200 OK', headers)
+
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper:
+        return file_wrapper(filehandle, CHUNK_SIZE)
+    return FileIterator(filehandle)
+
+
+def serve_ranges(start_response, filehandle, mime_type, headers, ranges,
+        size):
+    """
+    Respond with the ranges, a list of (first, last) byte positions,
+    of the open file filehandle, of size bytes. Several ranges are
+    sent as multipart/byteranges. Each is read from where it starts
+    in the file, so none of the file is held in memory.
+    """
+    if not ranges:
+        filehandle.close()
+        headers.append(('Content-Range', 'bytes */%s' % size))
+        start_response('416 Requested Range Not Satisfiable', headers)
+        return []
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        headers.extend([
+            ('Content-Type', mime_type),
+            ('Content-Range', 'bytes %s-%s/%s' % (first, last, size)),
+            ('Content-Length', str(last - first + 1)),
+        ])
+        start_response('206 Partial Content', headers)
+        return RangeIterator(filehandle, [('', first, last)])
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for first, last in ranges:
+        part_headers = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %s-%s/%s\r\n\r\n'
+                % (boundary, mime_type, first, last, size))
+        parts.append((part_headers, first, last))
+        length += len(part_headers) + last - first + 1
+    closing = '\r\n--%s--\r\n' % boundary
+    headers.extend([
+        ('Content-Type', 'multipart/byteranges; boundary=%s' % boundary),
+        ('Content-Length', str(length + len(closing))),
+    ])
+    start_response('206 Partial Content', headers)
+    return RangeIterator(filehandle, parts, closing)
+
+
+class RangeIterator(FileIterator):
+    """
+    Iterate over parts of an open file. Each part is a (prefix,
+    first, last) of a string to send and then the bytes from first
+    to last, after which suffix is sent.
+    """
+
+    def __init__(self, filehandle, parts, suffix='', chunk_size=CHUNK_SIZE):
+        FileIterator.__init__(self, filehandle, chunk_size)
+        self.parts = parts
+        self.suffix = suffix
+
+    def __iter__(self):
+        for prefix, first, last in self.parts:
+            if prefix:
+                yield prefix
+            self.filehandle.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = self.filehandle.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if self.suffix:
+            yield self.suffix
+
+
+def parse_ranges(header, size):
+    """
+    The (first, last) byte positions asked for by the Range header,
+    for a file of size bytes. None if the header is to be ignored,
+    because it is not for bytes, is malformed or asks for more than
+    MAX_RANGES ranges. An empty list if no range can be satisfied.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # the last so many bytes
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix and size:
+                    ranges.append((max(size - suffix, 0), size - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+        if first < 0 or (last is not None and last < first):
+            return None
+        if first < size:
+            if last is None or last >= size:
+                last = size - 1
+            ranges.append((first, last))
+    return ranges
+
+
+def if_range_matches(environ, etag, mtime):
+    """
+    True if there is no If-Range in the request, or it matches
+    etag or mtime, so any Range is to be honoured.
+    """
+    if_range = environ.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        # only a strong match will do
+        return if_range == etag
+    since = email.utils.parsedate_tz(if_range)
+    return bool(since) and int(mtime) == email.utils.mktime_tz(since)
+
+
+def file_etag(stat):
+    """
+    An ETag for a file made from its mtime and size.
+    """
+    return '"%x-%x"' % (int(stat.st_mtime * 1000), stat.st_size)
+
+
+def not_modified(environ, etag, mtime):
+    """
+    True if the request's If-None-Match matches etag or, when
+    there is no If-None-Match, its If-Modified-Since is no
+    earlier than mtime.
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        for candidate in if_none_match.split(','):
+            candidate = candidate.strip()
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate == '*' or candidate == etag:
+                return True
+        return False
+
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        since = email.utils.parsedate_tz(if_modified_since.split(';')[0])
+        if since:
+            return int(mtime) <= email.utils.mktime_tz(since)
+    return False
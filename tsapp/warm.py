@@ -0,0 +1,145 @@
+"""
+Warm the proxy's cache at startup.
+
+The local HTML (and optionally JavaScript) is scanned for references
+to the target server, such as /bags/x/tiddlers/y, and those which will
+not be answered locally are fetched through the app in a background
+thread, so the first page load finds them already cached.
+"""
+
+from __future__ import absolute_import
+
+import glob
+import os
+import re
+import sys
+import threading
+import time
+import urllib2
+
+from .proxy import find_local
+from .workers import run_jobs
+
+
+# Paths at the target server worth fetching ahead of time.
+SERVER_PATHS = ('bags', 'recipes', 'spaces', 'users', 'status', 'search')
+
+
+def start_warm(app, config):
+    """
+    Start warming app, a proxy App, in a daemon thread, and
+    return the thread. Requests are served meanwhile.
+    """
+    thread = threading.Thread(target=warm, args=(app, config))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def warm(app, config):
+    """
+    Fetch the references found in the local files through app,
+    up to warm_workers at a time, stopping new fetches once
+    warm_budget seconds have passed.
+    """
+    start = time.time()
+    deadline = start + float(config.get('warm_budget', 10))
+    workers = int(config.get('warm_workers', 4))
+
+    names = glob.glob('*.html')
+    if config.get('warm_js'):
+        names += glob.glob('*.js') + glob.glob(os.path.join('assets', '*.js'))
+    server_prefix = config.get('server_prefix')
+    references = [path for path in find_references(names,
+        config.get('target_server'), server_prefix)
+        if not find_local(app.index, path.split('?')[0].lstrip('/').split('/'),
+            server_prefix)]
+
+    def fetch(path):
+        if time.time() >= deadline:
+            return None
+        return prefetch(app, path)
+
+    counts = {'warmed': 0, 'late': 0, 'failed': 0}
+    for path, status, exc in run_jobs(fetch, references, workers):
+        if exc or (status and not status.startswith('2')):
+            counts['failed'] += 1
+        elif status is None:
+            counts['late'] += 1
+        else:
+            counts['warmed'] += 1
+    counts['total'] = len(references)
+    counts['time'] = time.time() - start
+    sys.stdout.write('Warmed %(warmed)s of %(total)s references in '
+            '%(time).2fs, %(failed)s failed, %(late)s out of time\n' % counts)
+    sys.stdout.flush()
+
+
+def find_references(names, target_server=None, server_prefix=None):
+    """
+    The distinct target server paths, with query, mentioned in the
+    files names, in the order found. Root relative paths count, as
+    do absolute URIs at target_server.
+    """
+    collections = SERVER_PATHS
+    if server_prefix:
+        collections = collections + (server_prefix,)
+    prefix = ''
+    if target_server:
+        prefix = '(?:%s)?' % re.escape(target_server.rstrip('/'))
+    pattern = re.compile(r'''["'(=]\s*%s(/(?:%s)(?=[/?"'\s)])'''
+            r'''[^"'\s()<>#\\]*)'''
+            % (prefix, '|'.join(re.escape(name) for name in collections)))
+
+    references = []
+    seen = set()
+    for name in names:
+        try:
+            source = open(name)
+        except IOError:
+            continue
+        try:
+            content = source.read()
+        finally:
+            source.close()
+        for match in pattern.finditer(content):
+            path = match.group(1).replace('&amp;', '&')
+            if path not in seen:
+                seen.add(path)
+                references.append(path)
+    return references
+
+
+def prefetch(app, path):
+    """
+    GET path, with query, through app and discard the body.
+    Return the status. The Accept header is the one a browser
+    is likely to send: JSON for a tiddler without an extension,
+    anything otherwise.
+    """
+    path_info, _, query_string = path.partition('?')
+    last = path_info.rsplit('/', 1)[-1]
+    if '.' in last:
+        accept = '*/*'
+    else:
+        accept = 'application/json'
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': urllib2.unquote(path_info),
+        'QUERY_STRING': query_string,
+        'HTTP_ACCEPT': accept,
+        'HTTP_ACCEPT_ENCODING': 'gzip',
+    }
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+
+    body = app(environ, start_response)
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return response.get('status')
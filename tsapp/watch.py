@@ -0,0 +1,220 @@
+"""
+Watch the local files and push them as they change.
+"""
+
+from __future__ import absolute_import
+
+import fnmatch
+import os
+import sys
+import time
+
+from .push import push_assets, delete_assets, find_sources
+
+
+# Files editors leave about which are never pushed when watching.
+IGNORED = ('*~', '#*#', '*.swp', '*.swx', '*.tmp', '4913')
+
+# However busy the files are, push at least this often, in seconds.
+MAX_DELAY = 5
+
+# Files which failed to push or delete are tried again after this
+# many seconds, if nothing has changed before then.
+RETRY_DELAY = 30
+
+
+def watch_assets(server, bag, auth_token, server_prefix=None, workers=1,
+        gzip=False, interval=1, debounce=0.5):
+    """
+    Push what has changed since the last push, then wait for *.html
+    and assets to change, pushing the files changed and deleting
+    the tiddlers of those removed. Changes are collected until none
+    have been seen for debounce seconds, so a burst of saves or a
+    checkout is pushed in one go. Files which fail to push or
+    delete are tried again with the next change, or after
+    RETRY_DELAY seconds.
+
+    inotify is used to wait if pyinotify is installed, otherwise
+    the files are stat'ed every interval seconds.
+    """
+    watcher = make_watcher(interval)
+    pushed = snapshot()
+    failed = _push(server, bag, auth_token, server_prefix, workers, gzip,
+            sorted(pushed))
+    for path in failed:
+        del pushed[path]
+    print 'Watching *.html and assets for changes (%s), Ctrl-C to stop' % (
+            watcher.name)
+    sys.stdout.flush()
+
+    while True:
+        if watcher.wait(failed and RETRY_DELAY or None):
+            deadline = time.time() + MAX_DELAY
+            while time.time() < deadline and watcher.wait(debounce):
+                pass
+
+        current = snapshot()
+        changed = sorted(path for path, stamp in current.items()
+                if pushed.get(path) != stamp)
+        removed = sorted(path for path in pushed if path not in current)
+        failed = []
+        if changed:
+            failed = _push(server, bag, auth_token, server_prefix, workers,
+                    gzip, changed)
+            # forgetting them makes them changed again next time
+            for path in failed:
+                current.pop(path, None)
+        if removed:
+            not_deleted = _delete(server, bag, auth_token, server_prefix,
+                    workers, removed)
+            # keeping them makes them removed again next time
+            for path in not_deleted:
+                current[path] = pushed[path]
+            failed.extend(not_deleted)
+        pushed = current
+        sys.stdout.flush()
+
+
+def _push(server, bag, auth_token, server_prefix, workers, gzip, paths):
+    """
+    Push paths, reporting rather than raising failures so watching
+    carries on. Return the paths which failed.
+    """
+    try:
+        return push_assets(server, bag, auth_token,
+                server_prefix=server_prefix, workers=workers, gzip=gzip,
+                paths=paths)
+    except IOError, exc:
+        sys.stderr.write('%s\n' % exc)
+        return list(paths)
+
+
+def _delete(server, bag, auth_token, server_prefix, workers, paths):
+    """
+    Delete the tiddlers of paths, reporting rather than raising
+    failures so watching carries on. Return the paths which failed.
+    """
+    try:
+        return delete_assets(server, bag, auth_token, paths,
+                server_prefix=server_prefix, workers=workers)
+    except IOError, exc:
+        sys.stderr.write('%s\n' % exc)
+        return list(paths)
+
+
+def snapshot():
+    """
+    The (mtime, size, inode) of each file that would be pushed,
+    by path, leaving out editor droppings.
+    """
+    stamps = {}
+    for path in find_sources():
+        if ignored(path):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if os.path.isdir(path):
+            continue
+        stamps[path] = (stat.st_mtime, stat.st_size, stat.st_ino)
+    return stamps
+
+
+def ignored(path):
+    """
+    True if path is an editor's temporary or backup file.
+    """
+    name = os.path.basename(path)
+    for pattern in IGNORED:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def make_watcher(interval):
+    """
+    An InotifyWatcher if pyinotify is installed, otherwise a
+    PollingWatcher checking every interval seconds.
+    """
+    try:
+        return InotifyWatcher()
+    except ImportError:
+        return PollingWatcher(interval)
+
+
+class PollingWatcher(object):
+    """
+    Tell when the files to push change by stat'ing them every
+    interval seconds.
+    """
+
+    name = 'polling'
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.stamps = snapshot()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change, for at most timeout seconds if given.
+        Return True if there was one.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            delay = self.interval
+            if deadline:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    return False
+            time.sleep(delay)
+            stamps = snapshot()
+            if stamps != self.stamps:
+                self.stamps = stamps
+                return True
+
+
+class InotifyWatcher(object):
+    """
+    Tell when the files to push change by waiting on inotify
+    events for the local dir and assets.
+    """
+
+    name = 'inotify'
+
+    def __init__(self):
+        import pyinotify
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE
+                | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+                | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB)
+        self.changed = False
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self._event)
+        for directory in ('.', 'assets'):
+            if os.path.isdir(directory):
+                self.manager.add_watch(directory, mask)
+
+    def _event(self, event):
+        path = os.path.relpath(event.pathname)
+        if ((path.endswith('.html') or path.startswith('assets' + os.sep))
+                and not ignored(path)):
+            self.changed = True
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change, for at most timeout seconds if given.
+        Return True if there was one.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self.changed = False
+        while not self.changed:
+            milliseconds = None
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                milliseconds = max(1, int(remaining * 1000))
+            if self.notifier.check_events(milliseconds):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        return True
@@ -0,0 +1,55 @@
+"""
+Run a function over many jobs with a bounded pool of threads.
+"""
+
+import Queue
+import threading
+
+
+def run_jobs(function, jobs, workers=1):
+    """
+    Call function once for each item in jobs, using at most
+    workers threads. Return a list of (job, result, exception)
+    tuples in the same order as jobs.
+
+    An exception raised while handling one job is captured in
+    its tuple rather than stopping the others. If workers is 1
+    (or less) everything runs in the calling thread.
+    """
+    results = [None] * len(jobs)
+
+    def run(index):
+        job = jobs[index]
+        try:
+            results[index] = (job, function(job), None)
+        except Exception, exc:
+            results[index] = (job, None, exc)
+
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        for index in range(len(jobs)):
+            run(index)
+        return results
+
+    queue = Queue.Queue()
+    for index in range(len(jobs)):
+        queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            run(index)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # join with a timeout so KeyboardInterrupt is still delivered
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+
+    return results